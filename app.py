@@ -1,13 +1,24 @@
-import json, github, io, flask_wtf, flask_wtf.file, wtforms, flask_cors
-from flask import Flask, Blueprint, send_file, render_template, flash, Markup
+import concurrent.futures, json, queue, re, github, flask_wtf, flask_wtf.file, wtforms, flask_cors
+from flask import Flask, Blueprint, Response, request, render_template, flash, Markup
 from flask_restx import Api, Resource
 from keyboard import Keyboard
+from cache import RenderCache
+from atlas import atlas
+from typeface import fonts, labels
+from assets import prefetcher, AssetStore
+from gists import GistCache
+import encoders
+from tiles import png_stream
+from archive import zip_stream
+from jobs import JobQueue
+from sessions import SessionStore
+from key import caps
+import atlas as atlas_module, metrics
 
 
 app = Flask(__name__)
 app.config.from_object('config')
 flask_cors.CORS(app)
-github_api = github.Github(app.config['API_TOKEN'])  
 blueprint = Blueprint('api', __name__, url_prefix='/api')
 api = Api(
     blueprint, version='1.0', title='KLE-Render API',
@@ -18,32 +29,334 @@ kle_parser.add_argument(
     'data', required=True, location='json',
     help='Downloaded strict JSON from Raw Data tab of Keyboard Layout Editor'
 )
+batch_parser = api.parser()
+batch_parser.add_argument('layouts', type=list, location='json', help='List of raw data layouts')
+batch_parser.add_argument('gists', type=list, location='json', help='List of gist ids')
 app.register_blueprint(blueprint)
+gist_cache = GistCache(
+    app.config['API_TOKEN'], app.config['GITHUB_API_URL'], app.config['GIST_CACHE_TTL'],
+    app.config['GIST_CACHE_SIZE']
+)
+render_cache = RenderCache(
+    app.config['RENDER_CACHE_BYTES'], app.config['RENDER_CACHE_DIR'],
+    app.config['RENDER_CACHE_DISK_BYTES']
+)
+
+# separate from keyboard's pools so batch items can render keys in parallel too
+batch_pool = concurrent.futures.ThreadPoolExecutor(app.config['BATCH_WORKERS'])
+
+
+def prewarm_atlas():
+    # runs before gunicorn forks so workers share tinted images
+    atlas.cache.max_bytes = app.config['ATLAS_BYTES']
+    fonts.cache.max_bytes = app.config['FONT_CACHE_BYTES']
+    fonts.path, fonts.max_disk_bytes = app.config['FONT_DIR'], app.config['FONT_DIR_BYTES']
+    labels.masks.max_bytes = app.config['LABEL_CACHE_BYTES']
+    prefetcher.timeout, prefetcher.budget = app.config['ASSET_TIMEOUT'], app.config['ASSET_BUDGET']
+    prefetcher.max_asset_bytes = app.config['ASSET_MAX_BYTES']
+    if app.config['ASSET_STORE_DIR']:
+        prefetcher.store = AssetStore(app.config['ASSET_STORE_DIR'], app.config['ASSET_STORE_BYTES'])
+    if app.config['ATLAS_PATH']: atlas.load(app.config['ATLAS_PATH'])
+    atlas.prewarm(color for color in app.config['ATLAS_PREWARM_COLORS'].split(',') if color)
+    for path in app.config['ATLAS_PREWARM_LAYOUTS'].split(','):
+        if not path: continue
+        with open(path) as f: keyboard = Keyboard(json.load(f))
+        atlas.prewarm_layout(keyboard.keys, keyboard.get_scale())
+    if app.config['ATLAS_PATH']:
+        atlas.save(app.config['ATLAS_PATH'])
+        atlas.persist(app.config['ATLAS_PATH'], app.config['ATLAS_SAVE_INTERVAL'])
+
+
+prewarm_atlas()
+
+
+def render_layout(layout, fmt='png', preview=None):
+    # reuse encoded image when same layout was already rendered in this format and size
+    preview = preview or {}
+    key = render_cache.key(layout, format=fmt, **preview)
+    data = render_cache.get(key)
+    if data is None:
+        workers, chunksize, processes = (app.config[k] for k in ('RENDER_WORKERS', 'RENDER_CHUNKSIZE', 'RENDER_PROCESSES'))
+        keyboard = Keyboard(layout)
+        with metrics.timed('render'):
+            if preview: img = keyboard.preview(preview['width'], preview['height'], preview['flat'], workers, chunksize, processes)
+            else: img = keyboard.render(workers, chunksize, processes)
+        data = encoders.encode(img, fmt)
+        # renders missing a failed or late asset aren't cached, so the next request tries again
+        if not keyboard.missing_assets: render_cache.set(key, data)
+    return data
+
+
+def serve_image(data, fmt='png', negotiated=False):
+    # send encoded bytes as they are, without copying into a file object
+    response = Response(data, mimetype=encoders.get_mimetype(fmt))
+    # format chosen from Accept header, so caches have to keep one copy per header
+    if negotiated: response.headers['Vary'] = 'Accept'
+    return response
+
+
+def stream_layout(layout):
+    # full resolution png encoded tile by tile while it's sent, cached once complete
+    key = render_cache.key(layout, format='png', full=True)
+    data = render_cache.get(key)
+    if data is not None: return serve_image(data)
+    workers, chunksize, processes = (app.config[k] for k in ('RENDER_WORKERS', 'RENDER_CHUNKSIZE', 'RENDER_PROCESSES'))
+    keyboard = Keyboard(layout)
+    tiles = keyboard.render_tiles(app.config['RENDER_TILE_SIZE'], 1, workers, chunksize, processes)
+
+    chunks = png_stream(keyboard.max_size, tiles)
+    return Response(chunks if keyboard.missing_assets else render_cache.tee(key, chunks), mimetype='image/png')
+
+
+def serve_layout(layout):
+    if request.args.get('full', '').lower() in ('1', 'true'): return stream_layout(layout)
+    fmt, preview = get_format(), get_preview()
+    response = serve_image(render_layout(layout, fmt, preview), fmt, is_negotiated())
+    if preview and request.args.get('progressive', '').lower() in ('1', 'true'):
+        # preview is sent right away, full render is queued and linked for the client to fetch
+        try:
+            job = submit_job(layout, fmt)
+        except queue.Full:
+            return response
+        response.headers['Link'] = '<{}>; rel="alternate"'.format(api.url_for(JobResult, id=job['id']))
+    return response
+
+
+def get_format():
+    return encoders.negotiate(request.args.get('format'), request.headers.get('Accept'))
 
 
-def serve_pil_image(pil_img):
-    img_io = io.BytesIO()
-    pil_img.save(img_io, 'PNG', compress_level=3)
-    img_io.seek(0)
-    return send_file(img_io, mimetype='image/png')
+def is_negotiated():
+    return request.args.get('format') not in encoders.encoders
+
+
+def get_preview():
+    # target size of a thumbnail rendered at that resolution, empty for a full render
+    width, height = (max(request.args.get(k, 0, type=int), 0) or None for k in ('width', 'height'))
+    flat = request.args.get('flat', '').lower() in ('1', 'true')
+    return {'width': width, 'height': height, 'flat': flat} if width or height or flat else {}
 
 
 @api.route('/<id>')
 @api.param('id', 'Copy from keyboard-layout-editor.com/#/gists/<id>')
+@api.param('format', 'One of ' + ', '.join(encoders.encoders) + ', otherwise png unless the Accept header rules it out')
+@api.param('full', 'Render png at full resolution, streamed tile by tile')
+@api.param('width', 'Render a preview at most this many pixels wide')
+@api.param('height', 'Render a preview at most this many pixels high')
+@api.param('flat', 'Render a preview with flat keycaps, much faster')
+@api.param('progressive', 'Also queue the full render, linked from the preview response')
 class FromGist(Resource):
     def get(self, id):
-        files = github_api.get_gist(id).files
-        layout = next(v for k, v in files.items() if k.endswith('.kbd.json'))
-        img = Keyboard(json.loads(layout.content)).render()
-        return serve_pil_image(img)
+        return serve_layout(gist_cache.get_layout(id))
 
 
 @api.route('/')
 @api.expect(kle_parser)
+@api.param('format', 'One of ' + ', '.join(encoders.encoders) + ', otherwise png unless the Accept header rules it out')
+@api.param('full', 'Render png at full resolution, streamed tile by tile')
+@api.param('width', 'Render a preview at most this many pixels wide')
+@api.param('height', 'Render a preview at most this many pixels high')
+@api.param('flat', 'Render a preview with flat keycaps, much faster')
+@api.param('progressive', 'Also queue the full render, linked from the preview response')
 class FromJSON(Resource):
     def post(self):
-        img = Keyboard(api.payload).render()
-        return serve_pil_image(img)
+        return serve_layout(api.payload)
+
+
+# jobs live in the worker that accepted them, polls landing on other gunicorn workers
+# only find finished results through the render cache, so set RENDER_CACHE_DIR with more than one
+jobs = JobQueue(
+    render_layout, app.config['JOB_WORKERS'], app.config['JOB_TTL'], app.config['JOB_MAX_QUEUED'],
+    app.config['JOB_RESULT_BYTES'], render_cache.has
+)
+
+
+def render_item(layout, id, fmt, preview):
+    return render_layout(gist_cache.get_layout(id) if id else layout, fmt, preview)
+
+
+def render_batch(items, fmt, preview):
+    # render items on the batch pool, zipping each as soon as it's done
+    futures = {batch_pool.submit(render_item, layout, id, fmt, preview): name for name, layout, id in items}
+    manifest = {}
+    for future in concurrent.futures.as_completed(futures):
+        name = futures[future]
+        try:
+            data = future.result()
+        except Exception as e:
+            # failed items get an error file instead of failing the archive
+            message = e.data.get('message') if isinstance(e, github.GithubException) else str(e)
+            manifest[name] = {'error': message or type(e).__name__}
+            yield name + '.error.txt', manifest[name]['error'].encode('utf-8')
+        else:
+            manifest[name] = {'file': name + '.' + encoders.get_mimetype(fmt).split('/')[1], 'bytes': len(data)}
+            yield manifest[name]['file'], data
+    yield 'manifest.json', json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+
+
+@api.route('/batch')
+@api.expect(batch_parser)
+@api.param('format', 'One of ' + ', '.join(encoders.encoders) + ', otherwise png')
+@api.param('width', 'Render previews at most this many pixels wide')
+@api.param('height', 'Render previews at most this many pixels high')
+@api.param('flat', 'Render previews with flat keycaps, much faster')
+class Batch(Resource):
+    def post(self):
+        payload = api.payload if isinstance(api.payload, dict) else {}
+        layouts, gists = payload.get('layouts') or [], payload.get('gists') or []
+        if not isinstance(layouts, list) or not isinstance(gists, list):
+            return {'message': 'layouts and gists must be lists'}, 400
+        if not 0 < len(layouts) + len(gists) <= app.config['BATCH_MAX_ITEMS']:
+            return {'message': 'Batch must have 1 to {} items'.format(app.config['BATCH_MAX_ITEMS'])}, 400
+
+        items = [('layout-{}'.format(i), layout, None) for i, layout in enumerate(layouts)]
+        items += [('gist-' + re.sub(r'\W', '_', id), None, id) for id in dict.fromkeys(map(str, gists))]
+        # archives aren't negotiated, a browser's Accept header would otherwise pick the format
+        fmt = encoders.negotiate(request.args.get('format'), None)
+        headers = {'Content-Disposition': 'attachment; filename=kle-render.zip'}
+        return Response(zip_stream(render_batch(items, fmt, get_preview())), mimetype='application/zip', headers=headers)
+
+
+def submit_job(layout, fmt, preview=None):
+    # job id is the render cache key, so identical submissions share a job
+    preview = preview or {}
+    id = render_cache.key(layout, format=fmt, **preview)
+    priority = sum(len(row) for row in layout if isinstance(row, list)) if isinstance(layout, list) else 0
+    return jobs.submit(id, priority if not preview else 0, (layout, fmt, preview), format=fmt, **preview)
+
+
+def submit_jobs(layout):
+    # with a preview, both it and the full render are queued, the preview ahead of everything else
+    fmt, preview = get_format(), get_preview()
+    try:
+        submitted = {name: submit_job(layout, fmt, options) for name, options in [('preview', preview), ('full', None)]}
+    except queue.Full:
+        return {'message': 'Too many queued jobs, try again later'}, 503
+    if not preview: return job_status(submitted['full']), 202
+    return {name: job_status(job) for name, job in submitted.items()}, 202
+
+
+def job_status(job):
+    fields = ('id', 'status', 'format', 'width', 'height', 'flat', 'priority', 'submitted', 'started', 'finished', 'error')
+    status = {k: job[k] for k in fields if k in job}
+    if job['status'] != 'done': return status
+    # results can be evicted before the job expires, submitting the layout again renders it again
+    if jobs.has_result(job['id']): status['result'] = api.url_for(JobResult, id=job['id'])
+    else: status['status'], status['error'] = 'expired', 'Result was evicted, submit the layout again'
+    return status
+
+
+@api.route('/jobs')
+@api.expect(kle_parser)
+@api.param('format', 'One of ' + ', '.join(encoders.encoders) + ', otherwise png unless the Accept header rules it out')
+@api.param('width', 'Render a preview at most this many pixels wide')
+@api.param('height', 'Render a preview at most this many pixels high')
+@api.param('flat', 'Render a preview with flat keycaps, much faster')
+class SubmitJSON(Resource):
+    def post(self):
+        return submit_jobs(api.payload)
+
+
+@api.route('/jobs/gists/<gist_id>')
+@api.param('gist_id', 'Copy from keyboard-layout-editor.com/#/gists/<id>')
+@api.param('format', 'One of ' + ', '.join(encoders.encoders) + ', otherwise png unless the Accept header rules it out')
+@api.param('width', 'Render a preview at most this many pixels wide')
+@api.param('height', 'Render a preview at most this many pixels high')
+@api.param('flat', 'Render a preview with flat keycaps, much faster')
+class SubmitGist(Resource):
+    def post(self, gist_id):
+        return submit_jobs(gist_cache.get_layout(gist_id))
+
+
+def find_job(id):
+    # job of this worker, or one finished by any worker whose result is in the render cache
+    job = jobs.get(id)
+    if job is not None or not re.fullmatch(r'[0-9a-f]{64}', id): return job
+    data = render_cache.get(id)
+    return {'id': id, 'status': 'done', 'format': encoders.guess_format(data)} if data is not None else None
+
+
+@api.route('/jobs/<id>')
+class JobStatus(Resource):
+    def get(self, id):
+        job = find_job(id)
+        if job is None: return {'message': 'Unknown or expired job'}, 404
+        return job_status(job)
+
+
+@api.route('/jobs/<id>/result')
+class JobResult(Resource):
+    def get(self, id):
+        job = find_job(id)
+        if job is None: return {'message': 'Unknown or expired job'}, 404
+        if job['status'] != 'done': return job_status(job), 202 if job['status'] != 'failed' else 500
+        # results over the job queue's budget may still be in the render cache
+        data = jobs.result(id) or render_cache.get(id)
+        if data is None: return {'message': 'Result was evicted, submit the layout again'}, 404
+        return serve_image(data, job['format'])
+
+
+sessions = SessionStore(app.config['SESSION_BYTES'], app.config['SESSION_TTL'])
+
+
+@api.route('/sessions/<session_id>')
+@api.param('session_id', 'Chosen by the client, up to 64 letters, digits, dashes or underscores')
+class RenderSession(Resource):
+    @api.expect(kle_parser)
+    @api.param('format', 'One of ' + ', '.join(encoders.encoders) + ', otherwise png unless the Accept header rules it out')
+    def post(self, session_id):
+        # re-renders only keys that changed since the last layout posted to this session
+        if not re.fullmatch(r'[\w-]{1,64}', session_id): return {'message': 'Invalid session id'}, 400
+        workers, chunksize, processes = (app.config[k] for k in ('RENDER_WORKERS', 'RENDER_CHUNKSIZE', 'RENDER_PROCESSES'))
+        fmt = get_format()
+        data = sessions.render(session_id, api.payload, fmt, workers, chunksize, processes)
+        return serve_image(data, fmt, is_negotiated())
+
+
+    def delete(self, session_id):
+        sessions.delete(session_id)
+        return '', 204
+
+
+def register_metrics():
+    # counters of every cache and queue, read when /metrics is scraped
+    metrics.enabled = app.config['METRICS_ENABLED']
+    sources = [('render_cache', render_cache), ('gist_cache', gist_cache), ('atlas', atlas), ('caps', caps)]
+    for name, source in sources + [('fonts', fonts), ('labels', labels), ('jobs', jobs), ('sessions', sessions)]: metrics.register(name, source.info)
+    for f in (atlas_module.get_base_color, atlas_module.lab_palette, atlas_module.open_base_img):
+        metrics.register(f.__name__, lambda f=f: f.cache_info()._asdict())
+    metrics.register('assets', lambda: prefetcher.store.stats if prefetcher.store else {})
+    metrics.register('encoders', lambda: {
+        stat: {fmt: entry[key] for fmt, entry in encoders.stats.items()}
+        for stat, key in (('encoded', 'count'), ('encode_seconds', 'seconds'), ('encoded_bytes', 'bytes'))
+    })
+
+
+register_metrics()
+
+
+@app.before_request
+def start_timing():
+    request.timing_token = metrics.begin()
+
+
+@app.after_request
+def add_server_timing(response):
+    # streamed responses render after this runs, so only cover what happened so far
+    header = metrics.server_timing()
+    if header: response.headers['Server-Timing'] = header
+    return response
+
+
+@app.teardown_request
+def end_timing(error):
+    metrics.end(getattr(request, 'timing_token', None))
+
+
+@app.route('/metrics')
+def metrics_text():
+    if not metrics.enabled: return 'Metrics are disabled\n', 404
+    return Response(metrics.export(), mimetype='text/plain; version=0.0.4')
 
 
 @api.errorhandler(github.GithubException)
@@ -55,6 +368,10 @@ class InputForm(flask_wtf.FlaskForm):
     url = wtforms.StringField('Copy the URL of a saved layout:')
     valid = [flask_wtf.file.FileAllowed(['json'], 'Upload must be JSON')]
     json = flask_wtf.file.FileField('Or upload raw JSON:', validators=valid)
+    width = wtforms.IntegerField(
+        'Preview width in pixels (optional):',
+        validators=[wtforms.validators.Optional(), wtforms.validators.NumberRange(min=1)]
+    )
 
 
 def flash_errors(form):
@@ -68,19 +385,17 @@ def flash_errors(form):
 def index():
     form = InputForm()
     if form.validate_on_submit():
+        preview = {'width': form.width.data, 'height': None, 'flat': False} if form.width.data else None
         if len(form.url.data) > 0:
             try:
-                files = github_api.get_gist(form.url.data.split('gists/', 1)[1]).files
-                layout = next(v for k, v in files.items() if k.endswith('.kbd.json'))
-                img = Keyboard(json.loads(layout.content)).render()
-                return serve_pil_image(img)
+                layout = gist_cache.get_layout(form.url.data.split('gists/', 1)[1])
+                return serve_image(render_layout(layout, preview=preview))
             except (IndexError, github.GithubException):
                 flash('Not a valid Keyboard Layout Editor gist')
         elif form.json.data:
             try:
                 content = json.loads(form.json.data.read().decode('utf-8'))
-                img = Keyboard(content).render()
-                return serve_pil_image(img)
+                return serve_image(render_layout(content, preview=preview))
             except ValueError:
                 flash(Markup('Invalid JSON input - see (?) for help'))
     flash_errors(form)
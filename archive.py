@@ -0,0 +1,34 @@
+import zipfile
+
+
+class ChunkWriter:
+    __slots__ = ['chunks']
+
+
+    def __init__(self):
+        # unseekable file for zipfile, drained after every entry
+        self.chunks = []
+
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+
+    def flush(self):
+        pass
+
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def zip_stream(entries):
+    # zip (name, data) pairs as they arrive, without buffering the whole archive
+    writer = ChunkWriter()
+    with zipfile.ZipFile(writer, 'w', zipfile.ZIP_STORED) as archive:
+        for name, data in entries:
+            archive.writestr(name, data)
+            yield writer.drain()
+    yield writer.drain()
@@ -0,0 +1,133 @@
+import concurrent.futures, hashlib, io, json, os, requests, requests.adapters, time
+from PIL import Image, ImageOps
+from cache import read_file, write_file, trim_dir
+
+
+class AssetStore:
+    __slots__ = ['path', 'max_bytes', 'size', 'stats']
+
+
+    def __init__(self, path, max_bytes):
+        # content addressed files shared by every worker and across restarts
+        self.path, self.max_bytes, self.size = path, max_bytes, None
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'evictions': 0}
+        os.makedirs(path, exist_ok=True)
+
+
+    def lookup(self, url):
+        # validators and content of last download of url
+        name = 'url-' + hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json'
+        try: meta = json.loads(read_file(os.path.join(self.path, name)) or b'null')
+        except ValueError: meta = None
+        data = meta and read_file(os.path.join(self.path, 'blob-' + meta['digest']))
+        return (meta, data) if data is not None else (None, None)
+
+
+    def put(self, url, data, headers):
+        digest = hashlib.sha256(data).hexdigest()
+        meta = {'digest': digest, 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+        name = 'url-' + hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json'
+        meta = json.dumps(meta).encode('utf-8')
+        write_file(os.path.join(self.path, 'blob-' + digest), data)
+        write_file(os.path.join(self.path, name), meta)
+        self.written(len(data) + len(meta))
+
+
+    def get_legend(self, digest, size):
+        data = read_file(os.path.join(self.path, 'legend-{}-{}x{}.png'.format(digest, *size)))
+        self.stats['misses' if data is None else 'hits'] += 1
+        if data is None: return None
+        with Image.open(io.BytesIO(data)) as img: img.load()
+        return img
+
+
+    def put_legend(self, digest, size, img):
+        img_io = io.BytesIO()
+        img.save(img_io, 'PNG', compress_level=1)
+        write_file(os.path.join(self.path, 'legend-{}-{}x{}.png'.format(digest, *size)), img_io.getvalue())
+        self.written(len(img_io.getvalue()))
+
+
+    def written(self, size):
+        # same running estimate as RenderCache.written, so the store is only scanned once it may be over budget
+        if self.size is not None: self.size += size
+        if self.size is None or self.size > self.max_bytes:
+            evictions, self.size = trim_dir(self.path, self.max_bytes, int(self.max_bytes * 0.9))
+            self.stats['evictions'] += evictions
+
+
+class Prefetcher:
+    __slots__ = ['workers', 'timeout', 'budget', 'max_asset_bytes', 'store', 'session']
+
+
+    def __init__(self, workers=8, timeout=5.0, budget=15.0, max_asset_bytes=8 * 2**20):
+        # pooled session shared by every request in the process
+        self.workers, self.timeout, self.budget = workers, timeout, budget
+        self.max_asset_bytes, self.store = max_asset_bytes, None
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+    def fetch(self, url, deadline=None):
+        # revalidate stored copy instead of downloading it again
+        meta, data = self.store.lookup(url) if self.store else (None, None)
+        # uncompressed, so the body can be read as it arrives whatever urllib3 version is installed
+        headers = {'Accept-Encoding': 'identity'}
+        if meta and meta['etag']: headers['If-None-Match'] = meta['etag']
+        if meta and meta['last_modified']: headers['If-Modified-Since'] = meta['last_modified']
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if data is not None and response.status_code == 304:
+                self.store.stats['revalidated'] += 1
+                return data
+            response.raise_for_status()
+
+            # refuse oversized assets before and while downloading them
+            if int(response.headers.get('Content-Length') or 0) > self.max_asset_bytes:
+                raise ValueError('asset too large')
+            # timeout only bounds each read, so a slow trickle is cut off at the deadline,
+            # read1 returns what has arrived where a buffered read would wait for the whole chunk
+            read, content = getattr(response.raw, 'read1', None) or response.raw._fp.read1, bytearray()
+            while True:
+                chunk = read(64 * 1024)
+                if not chunk: break
+                content += chunk
+                if len(content) > self.max_asset_bytes: raise ValueError('asset too large')
+                if deadline and time.monotonic() > deadline: raise TimeoutError('asset too slow')
+            content = bytes(content)
+            if self.store: self.store.put(url, content, response.headers)
+            return content
+
+
+    def prefetch(self, urls):
+        # download each distinct url concurrently within total time budget
+        urls = list(dict.fromkeys(url for url in urls if url))
+        if not urls: return {}
+        # threads are per call, so late downloads can't hold up other requests,
+        # and they give up at the deadline instead of running on in the background
+        deadline = time.monotonic() + self.budget
+        executor = concurrent.futures.ThreadPoolExecutor(min(self.workers, len(urls)))
+        futures = {executor.submit(self.fetch, url, deadline): url for url in urls}
+        done, _ = concurrent.futures.wait(futures, timeout=self.budget)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        # failed or late assets are left out, rendering falls back without them
+        results = dict.fromkeys(urls)
+        for future in done:
+            if not future.exception(): results[futures[future]] = future.result()
+        return results
+
+
+def get_legend(data, size):
+    # decode legend image and pad it to size, reusing stored bitmap when possible
+    store, digest = prefetcher.store, hashlib.sha256(data).hexdigest()
+    img = store.get_legend(digest, size) if store else None
+    if img is None:
+        with Image.open(io.BytesIO(data)) as label_img:
+            img = ImageOps.pad(label_img.convert('RGBA'), size, method=Image.BILINEAR)
+        if store: store.put_legend(digest, size, img)
+    return img
+
+
+prefetcher = Prefetcher()
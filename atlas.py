@@ -0,0 +1,200 @@
+import atexit, functools, hashlib, io, json, os, threading, time
+import numpy as np
+from PIL import Image, ImageColor, ImageCms
+from cache import LRUCache, write_file
+import metrics
+
+
+profiles = [(p, r) for p in ('GMK', 'SA') for r in ('BASE', 'SPACE', 'STEP', 'ISO', 'BIGENTER')]
+srgb_profile, lab_profile = ImageCms.createProfile('sRGB'), ImageCms.createProfile('LAB', colorTemp=5000)
+lab2rgb_transform = ImageCms.buildTransformFromOpenProfiles(lab_profile, srgb_profile, 'LAB', 'RGB')
+lightness_ramp = Image.frombytes('L', (256, 1), bytes(range(256)))
+srgb_linear = np.arange(256) / 255
+srgb_linear = np.where(srgb_linear <= 0.04045, srgb_linear / 12.92, ((srgb_linear + 0.055) / 1.055) ** 2.4)
+rgb2xyz_d65 = np.array([
+    (0.412424, 0.357579, 0.180464), (0.212656, 0.715158, 0.0721856), (0.0193324, 0.119193, 0.950444)
+])
+white_d65 = np.array((0.95047, 1.0, 1.08883))
+
+
+@functools.lru_cache(maxsize=1024)
+def get_base_color(color):
+    # calculate perceptual gray of key color
+    color = ImageColor.getrgb(color)
+    bright = 0.3 * color[0] + 0.59 * color[1] + 0.11 * color[2]
+
+    # get corresponding base image's average color
+    if (bright > 0xB0):
+        return 0xE0  # 224
+    elif (bright > 0x80):
+        return 0xB0  # 176
+    elif (bright > 0x50):
+        return 0x80  # 128
+    elif (bright > 0x20):
+        return 0x50  # 80
+    else:
+        return 0x20  # 32
+
+
+def color2lab(color):
+    # convert key color to 8 bit Lab (D65, matching colormath's sRGB to Lab)
+    rgb = np.array(ImageColor.getrgb(color)[:3]) / 255
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    t = rgb2xyz_d65 @ linear / white_d65
+    f = np.where(t > 216 / 24389, np.cbrt(t), 7.787 * t + 16 / 116)
+    l, a, b = 116 * f[1] - 16, 500 * (f[0] - f[1]), 200 * (f[1] - f[2])
+    # a and b should be scaled by 128/100, but desaturation looks more natural
+    return int(l * 256 / 100), int(a + 128), int(b + 128)
+
+
+def rgb2lightness(rgb):
+    # 8 bit L* of each pixel, within one step of the lcms sRGB to Lab transform
+    y = srgb_linear[rgb[..., 0]] * 0.2225045 + srgb_linear[rgb[..., 1]] * 0.7168786
+    y += srgb_linear[rgb[..., 2]] * 0.0606169
+    f = np.where(y > 216 / 24389, np.cbrt(y), (24389 / 27 * y + 16) / 116)
+    return np.rint((116 * f - 16) * 2.55).astype(np.int16)
+
+
+@functools.lru_cache(maxsize=4096)
+def lab_palette(a, b):
+    # sRGB of every 8 bit lightness at a fixed a and b
+    planes = (lightness_ramp, Image.new('L', (256, 1), a), Image.new('L', (256, 1), b))
+    ramp = ImageCms.applyTransform(Image.merge('LAB', planes), lab2rgb_transform)
+    return np.asarray(ramp).reshape(256, 3)
+
+
+@functools.lru_cache(maxsize=128)
+def open_base_img(full_profile, res, base_color):
+    # get base image according to profile and perceptual gray of key color
+    base_num = str([0xE0, 0xB0, 0x80, 0x50, 0x20].index(base_color) + 1)
+    with Image.open('images/{0}_{1}{2}.png'.format(*full_profile, base_num)) as img:
+        key_img = img.resize((int(s * res / 200) for s in img.size), resample=Image.BILINEAR).convert('RGBA')
+    pixels = np.asarray(key_img)
+    alpha = pixels[..., 3].copy() if full_profile[1] in ('ISO', 'BIGENTER') else 255
+    return rgb2lightness(pixels) - base_color, alpha
+
+
+@metrics.timer('tint')
+def tint_base_imgs(full_profile, res, base_color, colors):
+    # shift lightness of base image to that of each key color, replace a and b outright
+    lightness, alpha = open_base_img(full_profile, res, base_color)
+    imgs = []
+    for color in colors:
+        l1, a1, b1 = color2lab(color)
+        tinted = np.empty(lightness.shape + (4,), dtype=np.uint8)
+        tinted[..., :3] = lab_palette(a1, b1)[np.clip(lightness + l1, 0, 255)]
+        tinted[..., 3] = alpha
+        imgs.append(Image.fromarray(tinted, 'RGBA'))
+    return imgs
+
+
+def tint_base_img(full_profile, res, base_color, color):
+    return tint_base_imgs(full_profile, res, base_color, [color])[0]
+
+
+def img_bytes(img):
+    return img.width * img.height * len(img.getbands())
+
+
+class Atlas:
+    __slots__ = ['cache', 'path', 'interval', 'dirty', 'saved', 'lock']
+
+
+    def __init__(self, max_bytes):
+        # tinted base images shared by every key and request in the process
+        self.cache = LRUCache(max_bytes, sizeof=img_bytes)
+        self.path, self.interval, self.dirty, self.saved, self.lock = None, 0, False, 0, threading.Lock()
+
+
+    def get(self, full_profile, res, base_color, color):
+        key = (tuple(full_profile), res, base_color, color)
+        img = self.cache.get(key)
+        if img is None:
+            img = self.cache.set(key, tint_base_img(*key))
+            self.changed()
+        return img
+
+
+    def tint(self, wanted):
+        # batch missing (full_profile, res, color) entries by base image
+        batches = {}
+        for full_profile, res, color in wanted:
+            key = (tuple(full_profile), res, get_base_color(color), color)
+            if key not in self.cache.items: batches.setdefault(key[:3], set()).add(color)
+        for base, colors in batches.items():
+            colors = sorted(colors)
+            for color, img in zip(colors, tint_base_imgs(*base, colors)): self.cache.set((*base, color), img)
+        if batches: self.changed()
+
+
+    def prewarm(self, colors, res=200):
+        # tint every base image for each color ahead of first request
+        self.tint((full_profile, res, color) for color in colors for full_profile in profiles)
+
+
+    def prewarm_layout(self, keys, scale=1):
+        # tint only the base images a deserialised layout will use
+        self.tint(
+            ((key.get_full_profile()[0], row_profile), int(key.res / scale), key.color)
+            for key in keys if not key.decal for row_profile in {key.get_full_profile()[1], 'BASE'}
+        )
+
+
+    def persist(self, path, interval=300):
+        # save tints made while serving to path, at most every interval seconds and once more at exit
+        self.path, self.interval, self.saved = path, interval, time.monotonic()
+        atexit.register(self.flush)
+
+
+    def changed(self):
+        # new entries were tinted, saved in the background once interval has passed
+        self.dirty = True
+        if not self.path or time.monotonic() - self.saved < self.interval: return
+        self.saved = time.monotonic()
+        threading.Thread(target=self.flush, daemon=True).start()
+
+
+    def flush(self):
+        with self.lock:
+            if not self.path or not self.dirty: return
+            self.dirty = False
+            self.save(self.path)
+
+
+    def save(self, path):
+        # write each tinted image not saved yet as png, and add it to the index of cache keys
+        # other workers save to the same path, so their entries in the index are kept
+        os.makedirs(path, exist_ok=True)
+        try:
+            with open(os.path.join(path, 'index.json')) as f: index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        with self.cache.lock: items = [(k, v[0]) for k, v in self.cache.items.items()]
+        for key, img in items:
+            name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.png'
+            if name not in index or not os.path.exists(os.path.join(path, name)):
+                img_io = io.BytesIO()
+                img.save(img_io, 'PNG', compress_level=1)
+                write_file(os.path.join(path, name), img_io.getvalue())
+            index[name] = [list(key[0]), *key[1:]]
+        write_file(os.path.join(path, 'index.json'), json.dumps(index).encode('utf-8'))
+
+
+    def load(self, path):
+        try:
+            with open(os.path.join(path, 'index.json')) as f: index = json.load(f)
+        except (OSError, ValueError):
+            return
+        for name, (full_profile, res, base_color, color) in index.items():
+            try:
+                with Image.open(os.path.join(path, name)) as img: img.load()
+            except OSError:
+                continue
+            self.cache.set((tuple(full_profile), res, base_color, color), img)
+
+
+    def info(self):
+        return self.cache.info()
+
+
+atlas = Atlas(128 * 2**20)
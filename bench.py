@@ -0,0 +1,238 @@
+import argparse, copy, json, random, resource, sys, time, tracemalloc
+import numpy as np
+import atlas, encoders, key, mesh, typeface
+import keyboard as keyboard_module
+from keyboard import Keyboard
+
+
+legends = ['Esc', '!\n1', '@\n2', 'Q', 'W', 'E', 'Tab', 'Caps Lock', 'Shift', 'Ctrl', 'Alt', 'Page<br>Up', '&amp;\n7', '←', 'Enter', '']
+ansi = [
+    [1] * 13 + [2], [1.5] + [1] * 12 + [1.5], [1.75] + [1] * 11 + [2.25],
+    [2.25] + [1] * 10 + [2.75], [1.25] * 3 + [6.25] + [1.25] * 4
+]
+stages = ['deserialise', 'render', 'encode', 'total']
+
+
+def make_rows(widths, props=None, start=0):
+    # one kle row per list of widths, labels cycled from common legends
+    rows = []
+    for r, row in enumerate(widths):
+        items = [dict(props or {})] if props else []
+        for i, w in enumerate(row):
+            if w != 1: items.append({'w': w})
+            items.append(legends[(start + r * 7 + i) % len(legends)])
+        rows.append(items)
+    return rows
+
+
+def with_cluster(rows, extra, gap=0.25):
+    # append keys to the right of existing rows, like a nav cluster or numpad
+    extra = [item if isinstance(item, tuple) else (gap, item) for item in extra]
+    return [row + [{'x': x}] + make_rows([widths])[0] if widths else row for row, (x, widths) in zip(rows, extra)]
+
+
+def layout_40():
+    return make_rows([[1] * 12, [1.25] + [1] * 10 + [1.75], [1.75] + [1] * 10 + [1.25], [1.25] * 3 + [2.25, 2.75] + [1.25] * 3])
+
+
+def layout_60():
+    return [{'backcolor': '#222222', 'name': '60%'}] + make_rows(ansi, {'c': '#e0e0e0', 't': '#333333'})
+
+
+def layout_tkl():
+    f_row = make_rows([[1] * 13])[0]
+    rows = with_cluster(make_rows(ansi), [[1] * 3, [1] * 3, None, [1], [1] * 3])
+    return [f_row] + rows
+
+
+def layout_full():
+    tkl = layout_tkl()
+    return [tkl[0]] + with_cluster(tkl[1:], [[1] * 4, [1] * 4, (3.5, [1] * 3), (1.25, [1] * 4), [2, 1, 1]])
+
+
+def layout_1800():
+    return with_cluster(make_rows(ansi, {'p': 'SA R3'}), [[1] * 4, [1] * 4, [1] * 3, [1] * 4, [1] * 4], gap=0.5)
+
+
+def layout_iso():
+    rows = make_rows(ansi[:2] + [[1.75] + [1] * 12] + [[1.25] + [1] * 11 + [2.75], ansi[4]])
+    rows[1] = rows[1][:-2] + [{'w': 1.25, 'h': 2, 'w2': 1.5, 'h2': 1, 'x': 0.25, 'x2': -0.25}, 'Enter']
+    rows.append([{'w': 1.5, 'h': 2, 'w2': 2.25, 'h2': 1, 'x': 13.75, 'y': -4, 'x2': -0.75, 'y2': 1}, 'Big Enter'])
+    return rows
+
+
+def layout_stepped():
+    rows = make_rows(ansi, {'p': 'SA'})
+    rows[2] = [{'p': 'SA', 'w': 1.25, 'w2': 1.75, 'l': True}, 'Caps Lock', {'x': 0.5}] + rows[2][3:]
+    return rows
+
+
+def layout_rotated():
+    rows = make_rows([[1] * 7, [1.5] + [1] * 6, [1.75] + [1] * 6, [2.25] + [1] * 5])
+    rows += [[{'r': -10, 'rx': 8, 'ry': 0, 'c': '#aa3333'}] + make_rows([[1] * 7])[0]]
+    rows += [[{'r': 10, 'rx': 10, 'ry': 1, 'x': 1}] + make_rows([[1] * 6])[0]]
+    rows += [[{'r': 90, 'rx': 18, 'ry': 2, 'w': 2}, 'Space', 'Fn']]
+    return rows
+
+
+def layout_decals():
+    rows = make_rows(ansi)
+    rows.append([{'d': True, 'a': 7, 'f': 9, 'x': 4}, 'KLE Render', {'x': 2}, 'Decal'])
+    return rows
+
+
+def layout_ghost():
+    return [make_rows([row])[0] if r % 2 else [{'g': True}] + make_rows([row])[0] for r, row in enumerate(ansi)]
+
+
+def layout_kit():
+    colors = ['#e0e0e0', '#333333', '#aa3333', '#3355aa', '#ffcc00', '#11aa55']
+    rows = []
+    for i, color in enumerate(colors):
+        props = {'c': color, 't': '#ffffff\n\n#cc2222', 'p': 'SA' if i % 2 else 'GMK'}
+        rows += make_rows([[1] * 10, [1.25, 1.5, 1.75, 2, 2.25, 2.75]], props, start=i)
+    return rows
+
+
+def layout_stress(n=600, seed=0):
+    # random sizes, colors, profiles and legends, 500+ keys
+    rng, rows, row = random.Random(seed), [], []
+    colors = ['#e0e0e0', '#333333', '#aa3333', '#3355aa', '#ffcc00', '#11aa55']
+    for i in range(n):
+        if i % 24 == 0 and row: rows, row = rows + [row], []
+        props = {'c': rng.choice(colors), 't': rng.choice(['#000000', '#ffffff', '#cc2222'])}
+        if rng.random() < 0.2: props['w'] = rng.choice([1.25, 1.5, 1.75, 2, 2.25, 2.75, 6.25])
+        if rng.random() < 0.1: props['a'] = rng.choice([0, 4, 5, 6, 7])
+        if rng.random() < 0.1: props['p'] = rng.choice(['SA', 'DSA R3', 'GMK'])
+        row += [props, rng.choice(legends)]
+    return rows + [row]
+
+
+corpus = {
+    '40': layout_40, '60': layout_60, 'tkl': layout_tkl, 'full': layout_full, '1800': layout_1800,
+    'iso': layout_iso, 'stepped': layout_stepped, 'rotated': layout_rotated, 'decals': layout_decals,
+    'ghost': layout_ghost, 'kit': layout_kit, 'stress': layout_stress,
+}
+
+
+def clear_caches():
+    # drop every per-process cache so the next run starts cold
+    atlas.atlas.cache.clear()
+    key.caps.clear()
+    key.stretches.clear()
+    key.opaque.clear()
+    typeface.fonts.cache.clear()
+    typeface.labels.clear()
+    for f in (atlas.get_base_color, atlas.lab_palette, atlas.open_base_img, keyboard_module.parse_labels, keyboard_module.get_icons):
+        f.cache_clear()
+
+
+def run_once(layout, fmt):
+    times, layout = {}, copy.deepcopy(layout)
+    start = time.perf_counter()
+    keyboard = Keyboard(layout)
+    times['deserialise'], start = time.perf_counter() - start, time.perf_counter()
+    img = keyboard.render()
+    times['render'], start = time.perf_counter() - start, time.perf_counter()
+    encoders.encode(img, fmt)
+    times['encode'] = time.perf_counter() - start
+    times['total'] = sum(times.values())
+    return times, keyboard.stats
+
+
+def bench_mesh(repeat, vertices=20000, seed=0):
+    # stand-in keycap mesh deformed for a few key sizes, no blender needed
+    res, rng = key.Key().model_res, np.random.default_rng(seed)
+    co = np.column_stack([rng.uniform(-res, 0, vertices), rng.uniform(0, res, vertices), rng.uniform(0, res / 2, vertices)])
+    sizes, runs = [(2.25, 1), (6.25, 1), (1, 2), (0.5, 1), (1.25, 2)], []
+    for _ in range(repeat):
+        meshes = [mesh.ArrayMesh(co, vertices // 4) for _ in sizes]
+        start = time.perf_counter()
+        for model, (width, height) in zip(meshes, sizes): mesh.deform(model, res, width, height)
+        runs.append((time.perf_counter() - start) / len(sizes))
+    return {'vertices': vertices, 'deform': {p: percentile(runs, int(p[1:])) for p in ('p50', 'p90', 'p99')}}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p / 100 * len(values)), len(values) - 1)]
+
+
+def bench(names, repeat, fmt):
+    results = {}
+    for name in names:
+        layout = corpus[name]()
+        clear_caches()
+        cold, stats = run_once(layout, fmt)
+        warm = [run_once(layout, fmt)[0] for _ in range(repeat)]
+
+        # python side peak memory of one more warm run, pillow buffers aren't traced
+        tracemalloc.start()
+        run_once(layout, fmt)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        # share of keys reusing another key's render, and key images allocated
+        # the rest are composited straight onto the canvas
+        results[name] = {'keys': stats['keys'], 'hit_rate': stats['hit_rate'], 'cold': cold, 'peak_mb': peak / 2**20, 'warm': {
+            stage: {p: percentile([run[stage] for run in warm], int(p[1:])) for p in ('p50', 'p90', 'p99')}
+            for stage in stages
+        }, 'key_images': stats['key_images'], 'peak_key_mb': stats['peak_key_bytes'] / 2**20}
+    return {'format': fmt, 'repeat': repeat, 'layouts': results, 'mesh': bench_mesh(max(repeat, 5)),
+            'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def report(results):
+    header = ('layout', 'keys', 'dedupe', 'cold ms parse/render/encode', 'warm p50 ms', 'py MB', 'key imgs', 'img MB')
+    print('{:<8} {:>5}  {:>6}  {:>26}  {:>26}  {:>7}  {:>8}  {:>6}'.format(*header))
+    for name, result in results['layouts'].items():
+        cold = '/'.join('{:.0f}'.format(result['cold'][s] * 1000) for s in stages[:3])
+        warm = '/'.join('{:.0f}'.format(result['warm'][s]['p50'] * 1000) for s in stages[:3])
+        print('{:<8} {:>5}  {:>6.0%}  {:>26}  {:>26}  {:>7.1f}  {:>8}  {:>6.1f}'.format(
+            name, result['keys'], result['hit_rate'], cold, warm, result['peak_mb'], result['key_images'], result['peak_key_mb']
+        ))
+    print('mesh deform {} vertices p50 {:.2f}ms'.format(results['mesh']['vertices'], results['mesh']['deform']['p50'] * 1000))
+    print('max rss {:.0f} MB'.format(results['maxrss_mb']))
+
+
+def compare(results, baseline, threshold, min_delta):
+    # regressions in cold total and warm p50 of each stage beyond threshold and noise floor
+    regressions = []
+    for name, result in results['layouts'].items():
+        if name not in baseline['layouts']: continue
+        old = baseline['layouts'][name]
+        metrics = [('cold total', result['cold']['total'], old['cold']['total'])]
+        metrics += [('warm ' + s, result['warm'][s]['p50'], old['warm'][s]['p50']) for s in stages]
+        for metric, new, prev in metrics:
+            if new > prev * (1 + threshold) and new - prev > min_delta:
+                regressions.append('{} {}: {:.1f}ms -> {:.1f}ms'.format(name, metric, prev * 1000, new * 1000))
+    if 'mesh' in baseline:
+        new, prev = results['mesh']['deform']['p50'], baseline['mesh']['deform']['p50']
+        if new > prev * (1 + threshold) and new - prev > min_delta:
+            regressions.append('mesh deform: {:.1f}ms -> {:.1f}ms'.format(prev * 1000, new * 1000))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline render benchmarks on a synthetic layout corpus')
+    parser.add_argument('--only', default=','.join(corpus), help='comma separated layouts to run')
+    parser.add_argument('--repeat', type=int, default=5, help='warm runs per layout')
+    parser.add_argument('--format', default='png', choices=list(encoders.encoders))
+    parser.add_argument('--save', help='write results as json, e.g. to use as baseline')
+    parser.add_argument('--baseline', help='compare against results saved earlier')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown as a fraction')
+    parser.add_argument('--min-delta', type=float, default=0.005, help='ignore slowdowns under this many seconds')
+    args = parser.parse_args()
+
+    results = bench([name for name in args.only.split(',') if name], args.repeat, args.format)
+    report(results)
+    if args.save:
+        with open(args.save, 'w') as f: json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f: regressions = compare(results, json.load(f), args.threshold, args.min_delta)
+        for regression in regressions: print('REGRESSION', regression)
+        if regressions: sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import collections, hashlib, json, os, tempfile, threading
+
+
+class LRUCache:
+    __slots__ = ['max_bytes', 'sizeof', 'items', 'size', 'lock', 'stats']
+
+
+    def __init__(self, max_bytes, sizeof=len):
+        # evict least recently used items once total size exceeds max_bytes
+        self.max_bytes, self.sizeof = max_bytes, sizeof
+        self.items, self.size = collections.OrderedDict(), 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self.items.move_to_end(key)
+            return self.items[key][0]
+
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.items: self.size -= self.items.pop(key)[1]
+            if size > self.max_bytes: return value
+            self.items[key], self.size = (value, size), self.size + size
+            while self.size > self.max_bytes:
+                self.size -= self.items.popitem(last=False)[1][1]
+                self.stats['evictions'] += 1
+        return value
+
+
+    def pop(self, key):
+        # remove item, returning it or None when missing
+        with self.lock:
+            if key not in self.items: return None
+            value, size = self.items.pop(key)
+            self.size -= size
+            return value
+
+
+    def oldest(self):
+        # least recently used (key, value) without marking it used, None when empty
+        with self.lock: return next(((key, entry[0]) for key, entry in self.items.items()), None)
+
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
+    def info(self):
+        return dict(self.stats, items=len(self.items), bytes=self.size, max_bytes=self.max_bytes)
+
+
+class RenderCache:
+    __slots__ = ['memory', 'path', 'disk_bytes', 'disk_size', 'stats']
+
+
+    def __init__(self, max_bytes, path=None, disk_bytes=None):
+        # memory tier per process, optional disk tier shared between workers
+        self.memory = LRUCache(max_bytes)
+        self.path, self.disk_bytes, self.disk_size = path, disk_bytes, None
+        self.stats = {'disk_hits': 0, 'disk_evictions': 0}
+        if path: os.makedirs(path, exist_ok=True)
+
+
+    @staticmethod
+    def key(layout, **options):
+        # canonical hash of layout json and render options
+        text = json.dumps([layout, options], sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+    def get(self, key):
+        data = self.memory.get(key)
+        if data is not None or not self.path: return data
+        data = read_file(os.path.join(self.path, key))
+        if data is None: return None
+        self.stats['disk_hits'] += 1
+        return self.memory.set(key, data)
+
+
+    def has(self, key):
+        with self.memory.lock:
+            if key in self.memory.items: return True
+        return bool(self.path) and os.path.exists(os.path.join(self.path, key))
+
+
+    def set(self, key, data):
+        self.memory.set(key, data)
+        if not self.path: return data
+        write_file(os.path.join(self.path, key), data)
+        self.written(len(data))
+        return data
+
+
+    def tee(self, key, chunks):
+        # pass chunks through and cache them once complete, the disk tier is written as they go
+        # and memory only holds them while they'd still fit in the memory tier
+        buffer, size, complete = [], 0, False
+        f, tmp = open_temp(self.path) if self.path else (None, None)
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                if buffer is not None and size > self.memory.max_bytes: buffer = None
+                if buffer is not None: buffer.append(chunk)
+                if f: f = write_chunk(f, chunk)
+                yield chunk
+            complete = True
+        finally:
+            if f: f.close()
+            if tmp and f and complete:
+                try:
+                    os.replace(tmp, os.path.join(self.path, key))
+                    self.written(size)
+                except OSError:
+                    pass
+            elif tmp:
+                remove_file(tmp)
+        if buffer is not None: self.memory.set(key, b''.join(buffer))
+
+
+    def written(self, size):
+        # directory is only scanned once this process's running estimate goes over budget,
+        # then trimmed well under it, other workers' writes are caught up with at each scan
+        if not self.disk_bytes: return
+        if self.disk_size is not None: self.disk_size += size
+        if self.disk_size is None or self.disk_size > self.disk_bytes:
+            evictions, self.disk_size = trim_dir(self.path, self.disk_bytes, int(self.disk_bytes * 0.9))
+            self.stats['disk_evictions'] += evictions
+
+
+    def info(self):
+        return dict(self.memory.info(), **self.stats)
+
+
+def read_file(path):
+    # read file and mark it recently used, None if missing
+    try:
+        with open(path, 'rb') as f: data = f.read()
+        os.utime(path)
+        return data
+    except OSError:
+        return None
+
+
+def write_file(path, data):
+    # write atomically so other workers never read partial files
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f: f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def open_temp(path):
+    # temporary file in path, renamed over its key once complete
+    try:
+        fd, tmp = tempfile.mkstemp(dir=path, suffix='.tmp')
+        return os.fdopen(fd, 'wb'), tmp
+    except OSError:
+        return None, None
+
+
+def write_chunk(f, chunk):
+    # file to keep writing to, None once writing failed
+    try:
+        f.write(chunk)
+        return f
+    except OSError:
+        f.close()
+        return None
+
+
+def remove_file(path):
+    try: os.remove(path)
+    except OSError: pass
+
+
+def trim_dir(path, max_bytes, target=None):
+    # remove least recently used files down to target once directory exceeds its budget,
+    # returns evictions and bytes left
+    entries = []
+    for entry in os.scandir(path):
+        if entry.name.endswith('.tmp'): continue
+        try: stat = entry.stat()
+        except OSError: continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total, evictions = sum(size for _, size, _ in entries), 0
+    if total <= max_bytes: return 0, total
+    for _, size, path in sorted(entries):
+        if total <= (max_bytes if target is None else target): break
+        try: os.remove(path)
+        except OSError: continue
+        total, evictions = total - size, evictions + 1
+    return evictions, total
@@ -8,3 +8,36 @@ CORS_RESOURCES = r'/api/*'
 WTF_CSRF_ENABLED = False
 SECRET_KEY = os.environ.get('SECRET_KEY')
 API_TOKEN = os.environ.get('API_TOKEN')
+RENDER_CACHE_BYTES = int(os.environ.get('RENDER_CACHE_BYTES', 64 * 2**20))
+RENDER_CACHE_DIR = os.environ.get('RENDER_CACHE_DIR')
+RENDER_CACHE_DISK_BYTES = int(os.environ.get('RENDER_CACHE_DISK_BYTES', 1024 * 2**20))
+ATLAS_BYTES = int(os.environ.get('ATLAS_BYTES', 128 * 2**20))
+ATLAS_PATH = os.environ.get('ATLAS_PATH')
+ATLAS_SAVE_INTERVAL = float(os.environ.get('ATLAS_SAVE_INTERVAL', 300))
+ATLAS_PREWARM_COLORS = os.environ.get('ATLAS_PREWARM_COLORS', '#EEEEEE,#CCCCCC')
+ATLAS_PREWARM_LAYOUTS = os.environ.get('ATLAS_PREWARM_LAYOUTS', '')
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', 1))
+RENDER_CHUNKSIZE = int(os.environ.get('RENDER_CHUNKSIZE', 8))
+RENDER_PROCESSES = os.environ.get('RENDER_PROCESSES', '').lower() in ('1', 'true')
+RENDER_TILE_SIZE = int(os.environ.get('RENDER_TILE_SIZE', 256))
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 4))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 100))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_TTL = float(os.environ.get('JOB_TTL', 600))
+JOB_MAX_QUEUED = int(os.environ.get('JOB_MAX_QUEUED', 100))
+JOB_RESULT_BYTES = int(os.environ.get('JOB_RESULT_BYTES', 64 * 2**20))
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '').lower() in ('1', 'true')
+SESSION_BYTES = int(os.environ.get('SESSION_BYTES', 256 * 2**20))
+SESSION_TTL = float(os.environ.get('SESSION_TTL', 900))
+FONT_CACHE_BYTES = int(os.environ.get('FONT_CACHE_BYTES', 64 * 2**20))
+FONT_DIR = os.environ.get('FONT_DIR')
+FONT_DIR_BYTES = int(os.environ.get('FONT_DIR_BYTES', 256 * 2**20))
+LABEL_CACHE_BYTES = int(os.environ.get('LABEL_CACHE_BYTES', 32 * 2**20))
+ASSET_TIMEOUT = float(os.environ.get('ASSET_TIMEOUT', 5))
+ASSET_BUDGET = float(os.environ.get('ASSET_BUDGET', 15))
+ASSET_MAX_BYTES = int(os.environ.get('ASSET_MAX_BYTES', 8 * 2**20))
+ASSET_STORE_DIR = os.environ.get('ASSET_STORE_DIR')
+ASSET_STORE_BYTES = int(os.environ.get('ASSET_STORE_BYTES', 256 * 2**20))
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+GIST_CACHE_TTL = float(os.environ.get('GIST_CACHE_TTL', 300))
+GIST_CACHE_SIZE = int(os.environ.get('GIST_CACHE_SIZE', 256))
@@ -0,0 +1,62 @@
+import io, threading, time
+from PIL import Image
+import metrics
+
+
+# format, mimetype and save params of each encoder, tuned from measured speed vs size
+# e.g. 7749x3327 render: png 1.1s 2.4MB, png8 0.75s 0.4MB, webp 1.3s 0.25MB,
+# webp-lossless 5.9s 1.8MB, jpeg 0.1s 0.8MB
+encoders = {
+    'png': ('PNG', 'image/png', {'compress_level': 3}),
+    'png8': ('PNG', 'image/png', {'compress_level': 6}),
+    'webp': ('WEBP', 'image/webp', {'quality': 90, 'method': 2}),
+    'webp-lossless': ('WEBP', 'image/webp', {'lossless': True, 'quality': 0, 'method': 1}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 90}),
+}
+# lossless webp for image/webp, so negotiation never silently makes output lossy
+mimetypes = {'image/png': 'png', 'image/webp': 'webp-lossless', 'image/jpeg': 'jpeg'}
+stats, stats_lock = {}, threading.Lock()
+
+
+def negotiate(name, accept):
+    # explicit format wins, otherwise png unless the Accept header rules out png and image/*
+    if name in encoders: return name
+    quality = {}
+    for item in (accept or '*/*').split(','):
+        mimetype, *params = [part.strip() for part in item.split(';')]
+        q = next((p[2:] for p in params if p.startswith('q=')), '1')
+        try: quality[mimetype.lower()] = float(q)
+        except ValueError: continue
+    png = next((quality[m] for m in ('image/png', 'image/*', '*/*') if m in quality), 0.0)
+    if png > 0: return 'png'
+    best, best_q = 'png', 0.0
+    for mimetype, q in quality.items():
+        if mimetype in mimetypes and q > best_q: best, best_q = mimetypes[mimetype], q
+    return best
+
+
+def encode(img, name):
+    # encode image and record time and size per format
+    fmt, _, params = encoders[name]
+    start, img_io = time.perf_counter(), io.BytesIO()
+    if name == 'png8': img = img.quantize(256, method=Image.Quantize.FASTOCTREE)
+    img.save(img_io, fmt, **params)
+    data, elapsed = img_io.getvalue(), time.perf_counter() - start
+    if metrics.enabled: metrics.record('encode', elapsed)
+    with stats_lock:
+        entry = stats.setdefault(name, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+        entry['count'] += 1
+        entry['seconds'] += elapsed
+        entry['bytes'] += len(data)
+    return data
+
+
+def guess_format(data):
+    # encoder with the mimetype of already encoded bytes
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP': return 'webp'
+    if data[:3] == b'\xff\xd8\xff': return 'jpeg'
+    return 'png'
+
+
+def get_mimetype(name):
+    return encoders[name][1]
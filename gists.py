@@ -0,0 +1,64 @@
+import concurrent.futures, github, json, requests, threading, time
+from cache import LRUCache
+
+
+class GistCache:
+    __slots__ = ['api_url', 'token', 'ttl', 'timeout', 'session', 'entries', 'inflight', 'lock']
+
+
+    def __init__(self, token, api_url='https://api.github.com', ttl=300, max_items=256, timeout=10):
+        # parsed layouts by gist id, revalidated with etags once ttl runs out
+        self.api_url, self.token, self.ttl, self.timeout = api_url.rstrip('/'), token, ttl, timeout
+        self.session = requests.Session()
+        self.entries = LRUCache(max_items, sizeof=lambda entry: 1)
+        self.inflight, self.lock = {}, threading.Lock()
+
+
+    def get_layout(self, id):
+        entry = self.entries.get(id)
+        if entry and entry['expires'] > time.monotonic(): return entry['layout']
+
+        # coalesce concurrent requests for the same gist into one fetch
+        with self.lock:
+            future, leader = self.inflight.get(id), id not in self.inflight
+            if leader: future = self.inflight[id] = concurrent.futures.Future()
+        if not leader: return future.result()
+        try:
+            future.set_result(self.fetch(id, entry))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock: del self.inflight[id]
+        return future.result()
+
+
+    def fetch(self, id, entry):
+        headers = {'Accept': 'application/vnd.github+json'}
+        if self.token: headers['Authorization'] = 'token ' + self.token
+        if entry and entry['etag']: headers['If-None-Match'] = entry['etag']
+        response = self.session.get(f'{self.api_url}/gists/{id}', headers=headers, timeout=self.timeout)
+
+        # unchanged gists don't count against the rate limit
+        if entry and response.status_code == 304:
+            entry['expires'] = time.monotonic() + self.ttl
+            return entry['layout']
+        if response.status_code == 404:
+            raise github.UnknownObjectException(404, {'message': 'Not Found'}, response.headers)
+        if response.status_code != 200:
+            raise github.GithubException(response.status_code, {'message': response.reason}, response.headers)
+
+        # parse layout file once, following raw url if api truncated it
+        files = response.json()['files']
+        layout = next((v for k, v in files.items() if k.endswith('.kbd.json')), None)
+        if layout is None:
+            raise github.UnknownObjectException(404, {'message': 'No .kbd.json file in gist'}, response.headers)
+        content = layout['content']
+        if layout.get('truncated'): content = self.session.get(layout['raw_url'], timeout=self.timeout).text
+        entry = {'layout': json.loads(content), 'etag': response.headers.get('ETag')}
+        entry['expires'] = time.monotonic() + self.ttl
+        self.entries.set(id, entry)
+        return entry['layout']
+
+
+    def info(self):
+        return self.entries.info()
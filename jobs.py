@@ -0,0 +1,87 @@
+import itertools, queue, threading, time
+from cache import LRUCache
+
+
+class JobQueue:
+    __slots__ = [
+        'render', 'workers', 'ttl', 'max_queued', 'stored', 'queue', 'jobs', 'results', 'lock', 'threads', 'counter', 'stats'
+    ]
+
+
+    def __init__(self, render, workers=2, ttl=600, max_queued=100, max_bytes=64 * 2**20, stored=None):
+        # in-process jobs by id, smallest layouts first, kept for ttl seconds
+        # results are least recently used out once they total max_bytes, even before ttl,
+        # stored tells whether a result is still kept elsewhere, like a render cache
+        self.render, self.workers, self.ttl, self.max_queued = render, workers, ttl, max_queued
+        self.stored = stored or (lambda id: False)
+        self.queue, self.jobs, self.lock = queue.PriorityQueue(), {}, threading.Lock()
+        self.results = LRUCache(max_bytes)
+        self.threads, self.counter = [], itertools.count()
+        self.stats = {'submitted': 0, 'deduplicated': 0, 'done': 0, 'failed': 0, 'expired': 0}
+
+
+    def submit(self, id, priority, args, **fields):
+        # identical submissions share a job, failed ones and done ones whose result is gone are retried
+        with self.lock:
+            self.expire()
+            job = self.jobs.get(id)
+            if job and job['status'] != 'failed' and (job['status'] != 'done' or self.has_result(id)):
+                self.stats['deduplicated'] += 1
+                return job
+            if self.queue.qsize() >= self.max_queued: raise queue.Full()
+            job = self.jobs[id] = dict(fields, id=id, status='queued', priority=priority, submitted=time.time())
+            self.stats['submitted'] += 1
+            self.queue.put((priority, next(self.counter), id, args))
+
+            # threads are started lazily so they don't need to survive gunicorn's fork
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            while len(self.threads) < self.workers:
+                self.threads.append(threading.Thread(target=self.work, daemon=True))
+                self.threads[-1].start()
+            return job
+
+
+    def get(self, id):
+        with self.lock:
+            self.expire()
+            return self.jobs.get(id)
+
+
+    def result(self, id):
+        return self.results.get(id)
+
+
+    def has_result(self, id):
+        with self.results.lock:
+            if id in self.results.items: return True
+        return self.stored(id)
+
+
+    def work(self):
+        while True:
+            _, _, id, args = self.queue.get()
+            job = self.jobs[id]
+            job['status'], job['started'] = 'running', time.time()
+            try:
+                self.results.set(id, self.render(*args))
+            except Exception as e:
+                job['status'], job['error'] = 'failed', str(e) or type(e).__name__
+            else:
+                job['status'] = 'done'
+            job['finished'] = time.time()
+            with self.lock: self.stats[job['status']] += 1
+
+
+    def expire(self):
+        # drop finished jobs older than ttl, caller holds lock
+        now = time.time()
+        for id in [id for id, job in self.jobs.items() if job.get('finished', now) + self.ttl < now]:
+            del self.jobs[id]
+            self.results.pop(id)
+            self.stats['expired'] += 1
+
+
+    def info(self):
+        with self.lock:
+            info = dict(self.stats, queued=self.queue.qsize(), jobs=len(self.jobs), workers=len(self.threads))
+        return dict(info, result_bytes=self.results.size, result_evictions=self.results.stats['evictions'])
@@ -1,7 +1,19 @@
-import functools, io, math, requests
-from PIL import Image, ImageMath, ImageColor, ImageCms
-from PIL import ImageDraw, ImageFont, ImageOps
-from colormath import color_objects, color_conversions
+import math, threading
+import numpy as np
+from PIL import Image, ImageColor
+from atlas import atlas, get_base_color, img_bytes
+from cache import LRUCache
+from typeface import fonts, labels
+from assets import get_legend
+from mesh import as_mesh, deform
+import metrics
+
+
+# (width, height, x2, y2, width2, height2) of keys with their own base image, their row profile and size in units
+special_keys = {
+    (1.5, 1.0, 0.25, 0.0, 1.25, 2.0): ('ISO', (1.5, 2)), (1.25, 2.0, -0.25, 0.0, 1.5, 1.0): ('ISO', (1.5, 2)),
+    (1.5, 2.0, -0.75, 1.0, 2.25, 1.0): ('BIGENTER', (2.25, 2))
+}
 
 
 class Key:
@@ -9,7 +21,7 @@ class Key:
         'x', 'y', 'width', 'height', 'x2', 'y2', 'width2', 'height2',
         'rotation_angle', 'rotation_x', 'rotation_y', 'fonts',
         'res', 'flat', 'str_profile', 'decal', 'step', 'ghost', 'pic', 'color',
-        'align', 'labels', 'label_sizes', 'label_colors', 'model_res',
+        'align', 'labels', 'label_sizes', 'label_colors', 'model_res', 'pic_data',
     ]
 
 
@@ -34,9 +46,9 @@ class Key:
         self.label_sizes = [3.0] * 12
         self.label_colors = ['#000000'] * 12
         self.model_res = 0.01905
+        self.pic_data = None
 
 
-    @functools.lru_cache()
     def get_full_profile(self):
         # only GMK and SA base images
         full_profile = self.str_profile.upper().split(' ')
@@ -44,13 +56,8 @@ class Key:
 
         # row profile used to specify keys with special base images
         props = (self.width, self.height, self.x2, self.y2, self.width2, self.height2)
-        special_keys = {
-            (1.5, 1.0, 0.25, 0.0, 1.25, 2.0): 'ISO',
-            (1.25, 2.0, -0.25, 0.0, 1.5, 1.0): 'ISO',
-            (1.5, 2.0, -0.75, 1.0, 2.25, 1.0): 'BIGENTER'
-        } 
         if props in special_keys:
-            row_profile = special_keys[props]
+            row_profile = special_keys[props][0]
         elif self.step and self.height == self.height2:
             row_profile = 'STEP'
         elif (self.width >= 6.0 and self.height == 1.0) or (full_profile[-1] == 'SPACE'):
@@ -61,31 +68,16 @@ class Key:
         return (profile, row_profile)
 
 
-    @functools.lru_cache()
     def get_font(self, i, size, symbol):
+        # (key, font) pair from the registry, falling back to the profile's font
         path = 'fonts/{}_font.ttf'.format(self.get_full_profile()[0])
-        if symbol: return ImageFont.truetype(path, size)
-        try: return ImageFont.truetype(io.BytesIO(self.fonts[i]), size)
-        except Exception: return ImageFont.truetype(path, size)
+        if symbol or not self.fonts[i]: return fonts.lookup(path, size)
+        font = fonts.lookup(self.fonts[i], size)
+        return font if font[1] else fonts.lookup(path, size)
 
 
-    @functools.lru_cache()
     def get_base_color(self):
-        # calculate perceptual gray of key color
-        color = ImageColor.getrgb(self.color)
-        bright = 0.3 * color[0] + 0.59 * color[1] + 0.11 * color[2] 
-
-        # get corresponding base image's average color
-        if (bright > 0xB0):
-            return 0xE0  # 224
-        elif (bright > 0x80):
-            return 0xB0  # 176
-        elif (bright > 0x50):
-            return 0x80  # 128
-        elif (bright > 0x20):
-            return 0x50  # 80
-        else:
-            return 0x20  # 32
+        return get_base_color(self.color)
 
     
     def get_label_props(self):
@@ -118,23 +110,6 @@ class Key:
         return props
 
 
-    def get_location(self, key_img): 
-        # get pixel location of key as (left, upper, right, lower)
-        u = self.res
-        x, y = min(self.x, self.x + self.x2), min(self.y, self.y + self.y2)
-
-        if self.rotation_angle != 0 or self.rotation_x != 0 or self.rotation_y != 0:
-            # center about which to rotate key
-            rx, ry, a = self.rotation_x, self.rotation_y, math.radians(self.rotation_angle)
-            x2, y2 = x * math.cos(a) - y * math.sin(a), y * math.cos(a) + x * math.sin(a)
-
-            left, top = -self.width / 2, -self.height / 2
-            left2, top2 = left * math.cos(a) - top * math.sin(a), top * math.cos(a) + left * math.sin(a)
-
-            x, y = rx + x2 - key_img.width / u / 2 - left2, ry + y2 - key_img.height / u / 2 - top2
-        return (int(i) for i in (x * u, y * u, x * u + key_img.width, y * u + key_img.height))
-
-
     def get_model_location(self):
         # get bounding box of model in x/y plane
         x, y, res = min(self.x, self.x + self.x2), min(self.y, self.y + self.y2), self.model_res
@@ -151,67 +126,37 @@ class Key:
         if self.flat:
             res, color, row, sizes = self.res, self.color, full_profile[1], {'ISO': (1.5, 2), 'BIGENTER': (2.25, 2)}
             return Image.new('RGBA', [int(res * x) for x in sizes.get(row, (1, 1))], color=ImageColor.getrgb(color))
-        return open_base_img(full_profile, self.res, self.get_base_color(), self.color)
+        return atlas.get(full_profile, self.res, self.get_base_color(), self.color)
 
 
     def get_base_model(self, full_profile, scene):
         return copy_model('{0}_{1}'.format(*full_profile), scene)
 
 
-    def stretch_img(self, base_img, width, height): 
-        w, h = base_img.size
-        new_img = Image.new('RGBA', (width, height)) 
-        new_img.paste(base_img, (0, 0, base_img.width, base_img.height))
-
-        # stretch or crop base image horizontally
-        if width > w:
-            center_part = base_img.crop((int(w / 2), 0, int(w / 2) + 10, h))
-            right_part = base_img.crop((int(w / 2) + 1, 0, w, h))
-            for i in range(1, width - w + 1, 10):
-                new_img.paste(center_part, (int(w / 2) + i, 0, int(w / 2) + i + 10, h))
-            new_img.paste(right_part, (width - right_part.width, 0, width, h))
-        elif width < w:
-            right_part = base_img.crop((w - int(width / 2), 0, w, h))
-            new_img.paste(right_part, (width - right_part.width, 0, width, h))
-
-        # stretch or crop base image vertically
-        if height > h:
-            middle_part = new_img.crop((0, int(h / 2), width, int(h / 2) + 10))
-            bottom_part = new_img.crop((0, int(h / 2) + 1, width, h))
-            for i in range(1, height - h + 1, 10):
-                new_img.paste(middle_part, (0, int(h / 2) + i, new_img.width, int(h / 2) + i + 10))
-            new_img.paste(bottom_part, (0, height - bottom_part.height, width, height))
-        elif height < h:
-            bottom_part = new_img.crop((0, h - int(height / 2), width, h))
-            new_img.paste(bottom_part, (0, height - bottom_part.height, width, height))
-
-        return new_img
+    @metrics.timer('stretch_img')
+    def stretch_img(self, base_img, width, height, flip=False):
+        # repeat middle strip to stretch or keep both ends to shrink, as one gather per size
+        key = (id(base_img), width, height, flip)
+        entry = stretches.get(key)
+        if entry is None or entry[0] is not base_img:
+            w, h = base_img.size
+            cols, rows = stretch_map(w, width), stretch_map(h, height)
+            if flip: cols = np.where(cols < w, w - 1 - cols, w)
+            # whole pixels as uint32, with extra transparent row and column for pixels outside base image
+            pixels = np.zeros((h + 1, w + 1), dtype=np.uint32)
+            pixels[:h, :w] = np.asarray(base_img).view(np.uint32)[..., 0]
+            pixels = np.ascontiguousarray(pixels[rows][:, cols] if height < h else pixels[:, cols][rows])
+            img = Image.fromarray(pixels.view(np.uint8).reshape(height, width, 4), 'RGBA')
+            # keep base image alive so its id can't be reused by another image
+            entry = stretches.set(key, (base_img, img))
+        return entry[1]
 
 
     def stretch_model(self, model, width, height):
-        if width > 1:
-            # shift right section right
-            for v in model.data.vertices:
-                v.co[0] -= (width - 1) * self.model_res if v.co[0] < -self.model_res / 2 else 0
-        elif width < 1:
-            # keep left section, compress middle section, shift right section left
-            res, mid = self.model_res, width * self.model_res / 2
-            for v in model.data.vertices:
-                v.co[0] = v.co[0] if v.co[0] > -mid else (-mid if v.co[0] > -res + mid else v.co[0] + res - mid * 2)
-            for p in model.data.polygons: p.use_smooth = False
-
-        if height > 1:
-            # shift bottom section down
-            for v in model.data.vertices:
-                v.co[1] += (height - 1) * self.model_res if v.co[1] > self.model_res / 2 else 0
-        elif height < 1:
-            # keep top section, compress middle section, shift bottom section up
-            res, mid = self.model_res, height * self.model_res / 2
-            for v in model.data.vertices:
-                v.co[1] = v.co[1] if v.co[1] < mid else (mid if v.co[1] < res - mid else v.co[1] - res + mid * 2)
-            for p in model.data.polygons: p.use_smooth = False
+        # shift or compress sections of the base mesh, see mesh.stretch
+        deform(as_mesh(model), self.model_res, width, height)
+
 
-    
     def create_key(self):
         profile, row_profile = self.get_full_profile()
         if self.decal:
@@ -236,8 +181,8 @@ class Key:
                 overlap = int(0.3 * self.res)
                 # add left step
                 if x2 < 0:
-                    left_img = self.get_base_img((profile, row_profile)).copy().transpose(Image.FLIP_LEFT_RIGHT)
-                    left_step = self.stretch_img(left_img, int(-x2 * u + overlap + 1), int(height * u))
+                    left_img = self.get_base_img((profile, row_profile))
+                    left_step = self.stretch_img(left_img, int(-x2 * u + overlap + 1), int(height * u), flip=True)
                     key_img.paste(left_step, (0, 0))
                 # add right step
                 if max(-x2, 0) + self.width < width: 
@@ -276,18 +221,15 @@ class Key:
             height = max(self.height2 + y2, self.height) if y2 >= 0 else max(self.height - y2, self.height2)
             # create touch surface
             key_model = self.get_base_model((profile, 'BASE'), scene)
-            self.stretch_model(key_model, self.width, self.height)
-            # move touch surface mesh relative to object origin
-            for v in key_model.data.vertices:
-                v.co[0] -= max(-x2, 0) * model_res
-                v.co[1] += max(-y2, 0) * model_res
+            # stretch and move touch surface mesh relative to object origin
+            offset = (-max(-x2, 0) * model_res, max(-y2, 0) * model_res)
+            deform(as_mesh(key_model), model_res, self.width, self.height, offset)
             
             if row_profile == 'STEP':
                 # add left step
                 if x2 < 0:
                     left_step = self.get_base_model((profile, row_profile), scene)
-                    for v in left_step.data.vertices: v.co[0] = -model_res * 0.97 - v.co[0]
-                    self.stretch_model(left_step, -x2 + 0.333, height)
+                    deform(as_mesh(left_step), model_res, -x2 + 0.333, height, mirror=-model_res * 0.97)
                     left_step.parent = key_model
                 # add right step
                 if max(-x2, 0) + self.width < width: 
@@ -310,19 +252,20 @@ class Key:
             props = self.get_label_props()
             width, height = int(self.width * self.res), int(self.height * self.res)
             size = (width - props['margin_x'] * 2, height - props['margin_top'] - props['margin_bottom'])
-            with Image.open(requests.get(self.labels[0], stream=True).raw) as label_img:
-                label_img = label_img.convert('RGBA')
-                pic_img = ImageOps.pad(label_img, size, method=Image.BILINEAR)
-                key_img.paste(pic_img, (props['margin_x'], props['margin_top']), mask=pic_img)
+            pic_img = get_legend(self.pic_data, size)
+            key_img.paste(pic_img, (props['margin_x'], props['margin_top']), mask=pic_img)
             return key_img
         except Exception:
             return key_img
 
 
-    def label_key(self, key_img):
+    def label_key(self, key_img, canvas=None, origin=(0, 0), draw=True):
+        # labels of key_img, drawn onto canvas at origin when compositing straight onto it
+        # without draw, top legends are only laid out and rasterised into the label cache
+        canvas = key_img if canvas is None else canvas
         # if blank, exit immediately
         if len(self.labels) < 1: return key_img
-        if self.pic: return self.pic_key(key_img)
+        if self.pic: return self.pic_key(key_img) if draw else key_img
 
         props = self.get_label_props()
         width, height = int(self.width * self.res), int(self.height * self.res)
@@ -339,43 +282,101 @@ class Key:
             lambda h: props['margin_top'],
         ]
         aligns = ['left', 'center', 'right']
-        # seperate surface for front printed labels
-        top_draw = ImageDraw.Draw(key_img)
-        front_plane = Image.new('RGBA', (width, max(height - props['margin_bottom'] * 2, 1)))
-        front_draw = ImageDraw.Draw(front_plane)
-
-        for i in range(min(len(self.labels), 12)):
+        count = min(len(self.labels), 12)
+        # seperate surface for front printed labels, if there are any
+        front = draw and self.has_front_labels()
+        front_plane = Image.new('RGBA', (width, max(height - props['margin_bottom'] * 2, 1))) if front else None
+        limit = width - props['margin_x'] * 2 if not self.decal else None
+        upper = self.get_full_profile()[0] != 'GMK' and not self.decal
+
+        for i in range(count):
             (row, col), text = props['positions'][i], self.labels[i]
             if not text or row == None: continue
 
-            # load font and calculate text dimensions
+            # load font, then wrap and measure text once per process
             symbol = any(0x2190 <= ord(c) <= 0x26ff for c in text)
             font = self.get_font(row * 3 + col, props['font_sizes'][i], symbol)
-            text = break_text(text, font, width - props['margin_x'] * 2) if not self.decal else text
-            text = text.upper() if self.get_full_profile()[0] != 'GMK' and not self.decal else text
-            text_width, text_height = font.getsize_multiline(text, spacing=props['line_spacing'])
+            layout = labels.layout(text, font, props['line_spacing'], limit, upper)
+            text_width, text_height = layout[0]
             # retrieve label color and lighten to simulate reflectivity
             color = ImageColor.getrgb(self.label_colors[i])
             color = color if self.flat else tuple(band + 0x26 for band in color)
 
             # draw labels accordings to row/col of props
-            (front_draw if row == 3 else top_draw).multiline_text(
-                (col2x[col](text_width), row2y[row](text_height)), text, font=font,
-                fill=color, spacing=props['line_spacing'], align=aligns[col]
-            )
+            xy = (col2x[col](text_width), row2y[row](text_height))
+            if row != 3: labels.draw(canvas if draw else None, xy, layout, font, color, aligns[col], origin, key_img.size)
+            elif front: labels.draw(front_plane, xy, layout, font, color, aligns[col])
 
         # compress front printed labels vertically
+        if front_plane is None: return key_img
         front_plane = front_plane.resize((width, props['margin_bottom']), resample=Image.BILINEAR)
-        key_img.paste(front_plane, (x_offset, height - props['margin_bottom'] + y_offset), mask=front_plane)
+        location = (origin[0] + x_offset, origin[1] + height - props['margin_bottom'] + y_offset)
+        canvas.paste(front_plane, location, mask=front_plane)
         return key_img
 
 
-    def render(self, scale, flat):
+    def get_cap_signature(self):
+        # everything create_key depends on
+        geometry = (self.width, self.height, self.x2, self.y2, self.width2, self.height2)
+        return (self.get_full_profile(), geometry, self.color, self.decal, self.res, self.flat)
+
+
+    def get_signature(self):
+        # everything render depends on, keys with equal signatures look identical
+        labels = (tuple(self.labels), tuple(self.label_sizes), tuple(self.label_colors), tuple(self.fonts))
+        props = (self.str_profile, self.align, self.pic, self.ghost, self.rotation_angle)
+        return (self.get_cap_signature(), labels, props)
+
+
+    def set_scale(self, scale, flat):
         self.res, self.flat = int(self.res / scale), flat
+
+
+    def get_cap(self):
+        signature = self.get_cap_signature()
+        cap_img = caps.get(signature)
+        if cap_img is None:
+            with metrics.timed('create_key'): cap_img = caps.set(signature, self.create_key())
+        return cap_img
+
+
+    def has_front_labels(self):
+        # labels 4, 5 and 11 are printed on the front of the key
+        return any(self.labels[i] for i in (4, 5, 11) if i < len(self.labels))
+
+
+    def is_direct(self):
+        # keys that are only an opaque cap and top legends can be composited straight onto the canvas
+        # front legends are pasted with their alpha blended into the key's, which needs an image of the key
+        if self.ghost or self.pic or self.has_front_labels(): return False
+        if not (self.flat or self.rotation_angle % 360 == 0): return False
+        cap_img, signature = self.get_cap(), self.get_cap_signature()
+        is_opaque = opaque.get(signature)
+        if is_opaque is None: is_opaque = opaque.set(signature, cap_img.getextrema()[3][0] == 255)
+        return is_opaque
+
+
+    def warm(self):
+        # load the cap and rasterise top legends ahead of composite, which then only pastes
+        with metrics.timed('label_key'): self.label_key(self.get_cap(), draw=False)
+
+
+    def composite(self, canvas, location):
+        # same pixels as pasting render() at location, without an image of the key
+        cap_img = self.get_cap()
+        with metrics.timed('paste'): canvas.paste(cap_img, location, mask=cap_img)
+        with metrics.timed('label_key'): self.label_key(cap_img, canvas, location)
+
+
+    def render(self):
         # create key, then tint key, then label key
-        key_img = self.label_key(self.create_key())
-        if self.ghost: key_img.putalpha(Image.new('L', key_img.size, color=64))
-        if not flat: key_img = key_img.rotate(-self.rotation_angle, resample=Image.BILINEAR, expand=1)
+        cap_img, rotated = self.get_cap(), not self.flat
+        # rotated keys are labelled on a reused buffer, since rotating makes a new image anyway
+        key_img = get_scratch(cap_img) if rotated else cap_img.copy()
+        with metrics.timed('label_key'): key_img = self.label_key(key_img)
+        if self.ghost: key_img.putalpha(64)
+        if rotated:
+            with metrics.timed('rotate'): key_img = key_img.rotate(-self.rotation_angle, resample=Image.BILINEAR, expand=1)
         return key_img
 
     
@@ -390,50 +391,51 @@ class Key:
         return model
 
 
-srgb_profile, lab_profile = ImageCms.createProfile('sRGB'), ImageCms.createProfile('LAB', colorTemp=5000)
-rgb2lab_transform = ImageCms.buildTransformFromOpenProfiles(srgb_profile, lab_profile, 'RGB', 'LAB')
-lab2rgb_transform = ImageCms.buildTransformFromOpenProfiles(lab_profile, srgb_profile, 'LAB', 'RGB')
-
-
-@functools.lru_cache()
-def open_base_img(full_profile, res, base_color, color):
-    # get base image according to profile and perceptual gray of key color
-    base_num = str([0xE0, 0xB0, 0x80, 0x50, 0x20].index(base_color) + 1)
-
-    # open image and convert to Lab
-    with Image.open('images/{0}_{1}{2}.png'.format(*full_profile, base_num)) as img:
-        key_img = img.resize((int(s * res / 200) for s in img.size), resample=Image.BILINEAR).convert('RGBA')
-    if full_profile[1] in ('ISO', 'BIGENTER'): alpha = key_img.split()[-1]
-    l, a, b = ImageCms.applyTransform(key_img, rgb2lab_transform).split()
-
-    # convert key color to Lab
-    # a and b should be scaled by 128/100, but desaturation looks more natural
-    rgb_color = color_objects.sRGBColor(*ImageColor.getrgb(color), is_upscaled=True)
-    lab_color = color_conversions.convert_color(rgb_color, color_objects.LabColor)
-    l1, a1, b1 = lab_color.get_value_tuple()
-    l1, a1, b1 = int(l1 * 256 / 100), int(a1 + 128), int(b1 + 128)
-
-    # change Lab of base image to match that of key color
-    l = ImageMath.eval('convert(l + l1 - l_avg, "L")', l=l, l1=l1, l_avg=base_color)
-    a = ImageMath.eval('convert(a + a1 - a, "L")', a=a, a1=a1)
-    b = ImageMath.eval('convert(b + b1 - b, "L")', b=b, b1=b1)
-
-    key_img = ImageCms.applyTransform(Image.merge('LAB', (l, a, b)), lab2rgb_transform).convert('RGBA')
-    if full_profile[1] in ('ISO', 'BIGENTER'): key_img.putalpha(alpha)
-    return key_img
-
-
-@functools.lru_cache()
-def break_text(text, font, limit):
-    if not ' ' in text: return text
-    words, lines = text.split(' '), ['']
-    while words:
-        word = words.pop(0)
-        if font.getsize(lines[-1] + word)[0] + 1 < limit or len(lines[-1]) < 1:
-            lines[-1] += word + ' '
-        else:
-            lines.append(word + ' ')
-    return '\n'.join([line[:-1] for line in lines])
+caps = LRUCache(32 * 2**20, sizeof=img_bytes)
+# whether each cap is opaque everywhere, so its legends can be drawn on anything underneath
+opaque = LRUCache(16384, sizeof=lambda value: 1)
+scratch = threading.local()
+stretches = LRUCache(16 * 2**20, sizeof=lambda entry: img_bytes(entry[1]))
+
+
+def stretch_map(n, size):
+    # source pixel along one axis for each output pixel, n where it's transparent
+    out, middle = np.full(size, n), int(n / 2)
+    out[:min(n, size)] = np.arange(min(n, size))
+    if size > n:
+        # 10 pixel strip from middle repeats, then far end of base image
+        end = min(size, middle + 1 + math.ceil((size - n) / 10) * 10)
+        strip = middle + np.arange(end - middle - 1) % 10
+        out[middle + 1:end] = np.where(strip < n, strip, n)
+        out[size - (n - middle - 1):] = np.arange(middle + 1, n)
+    elif size < n:
+        # far half of base image replaces the end
+        half = int(size / 2)
+        out[size - half:] = np.arange(n - half, n)
+    return out
+
+
+def get_scratch(cap_img):
+    # copy of cap_img in an image reused by this thread for every cap of the same size
+    pool = scratch.__dict__.setdefault('pool', {})
+    img = pool.pop(cap_img.size, None) or Image.new('RGBA', cap_img.size)
+    pool[cap_img.size] = img
+    while len(pool) > 16: del pool[next(iter(pool))]
+    img.paste(cap_img, (0, 0))
+    return img
+
+
+def rotated_size(size, angle):
+    # output size of Image.rotate(angle, expand=1), computed the same way pillow does
+    (w, h), angle = size, angle % 360.0
+    if angle in (0, 180): return tuple(size)
+    if angle in (90, 270): return (h, w)
+    a, cx, cy = -math.radians(angle), w / 2.0, h / 2.0
+    cos, sin = round(math.cos(a), 15), round(math.sin(a), 15)
+    c, f = cos * -cx + sin * -cy + 0.0 + cx, -sin * -cx + cos * -cy + 0.0 + cy
+    xx = [cos * x + sin * y + c for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+    yy = [-sin * x + cos * y + f for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+    return (math.ceil(max(xx)) - math.floor(min(xx)), math.ceil(max(yy)) - math.floor(min(yy)))
 
 
 def copy_model(name, scene):
@@ -1,74 +1,249 @@
-import copy, html, lxml.html, re, json, requests, tinycss2
-from PIL import Image, ImageColor, ImageDraw, ImageFont
-from key import Key
+import collections, concurrent.futures, functools, math, html, lxml.html, re, json, threading, tinycss2
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+from key import Key, caps
+from keyset import KeySet
+from atlas import atlas, img_bytes
+from typeface import fonts, font_source
+from assets import prefetcher
+import metrics
+
+
+watermark = 'Made with kle-render.herokuapp.com'
+# no markup, and no characters libxml2 would replace, normalize or reject
+plain_label = re.compile('[^<&\x00-\x08\x0a-\x1f\ud800-\udfff\ufffe\uffff]*$')
 
 
 class Keyboard:
-    __slots__ = ['keys', 'keyboard', 'max_size', 'color']
+    __slots__ = [
+        'keys', 'keyset', 'keyboard', 'max_size', 'color', 'stats', 'scale', 'locations', 'signatures', 'missing_assets'
+    ]
 
 
     def __init__(self, json):
         # parse keyboard-layout-editor JSON format
-        data = deserialise(json)
-        self.keys, self.color = data[0], ImageColor.getrgb(data[1])
-        self.keyboard = Image.new('RGB', (1000, 1000), color=self.color)
-        self.max_size = (0, 0)
+        with metrics.timed('deserialise'): data = deserialise(json)
+        self.keyset, self.color, self.missing_assets = data[0], ImageColor.getrgb(data[1]), data[2]
+        self.keys = self.keyset.keys
+        self.keyboard, self.max_size = None, (0, 0)
+        self.stats, self.scale, self.locations, self.signatures = {}, 1, [], []
+
+
+    def get_scale(self):
+        # choose scale of canvas depending on number of keys
+        return min(int(len(self.keys) / 160 + 1), 5)
+
+
+    def get_preview_scale(self, width=None, height=None):
+        # smallest scale whose canvas fits within width and height, from the layout's size at scale 1
+        if not width and not height: return self.get_scale()
+        locations, scales = self.plan(1, 0), [1]
+        font, margin = self.get_watermark_font(1)
+        w, h = font.getsize(watermark)
+
+        # border is 24px left and above at any scale, everything else shrinks with it
+        if width: scales += [(max([l[2] for l in locations], default=0) + 24) / max(width - 24, 1), w / width]
+        if height: scales.append((max([l[3] for l in locations], default=0) + 24 + h + margin * 2) / max(height - 24, 1))
+
+        # below about 12px per unit fonts and base images stop scaling, downscale the rest
+        return min(max(scales), 16)
+
+
+    def plan(self, scale, border, flat=False):
+        # get pixel location of every key before rendering, from the same geometry
+        for key in self.keys: key.set_scale(scale, flat)
+        res = np.array([key.res for key in self.keys], dtype=int)
+        locations = (self.keyset.locations(res, flat) + border).tolist()
+        max_size = (max([l[2] for l in locations], default=0), max([l[3] for l in locations], default=0))
+
+        # leave room for border and watermark bar below keys
+        max_size = [size + int(border / scale) for size in max_size]
+        font, margin = self.get_watermark_font(scale)
+        w, h = font.getsize(watermark)
+        self.max_size = (max(w, max_size[0]), max_size[1] + h + margin * 2)
+        return locations
 
 
-    def render(self):
-        # choose size and scale of canvas depending on number of keys
-        scale, border = min(int(len(self.keys) / 160 + 1), 5), 24
+    def prepare(self, scale, flat=False):
+        # plan locations and find each visually distinct key, in order of first use
+        self.scale, self.locations = scale, self.plan(scale, 24, flat)
+        self.signatures, unique = [key.get_signature() for key in self.keys], {}
+        for signature, key in zip(self.signatures, self.keys): unique.setdefault(signature, key)
 
-        # render each key
-        for key in self.keys: self.render_key(key, scale, border)
+        # tint base images for every colorway at once, flat keys are solid colors
+        if not flat: atlas.prewarm_layout(unique.values())
+        return unique
 
-        # watermark and crop the image
-        self.max_size = [size + int(border / scale) for size in self.max_size]
-        self.watermark_keyboard('Made with kle-render.herokuapp.com', scale)
-        self.keyboard = self.keyboard.crop((0, 0, self.max_size[0], self.max_size[1]))
+
+    def render(self, workers=1, chunksize=8, processes=False, scale=None, flat=False):
+        # allocate canvas once at its final size
+        unique = self.prepare(scale or self.get_scale(), flat)
+        self.keyboard = Image.new('RGB', self.max_size, color=self.color)
+
+        # simple keys are composited straight onto the canvas, the rest are rendered to images first
+        direct = find_direct(unique, workers, chunksize, processes)
+        needed = [signature for signature in self.signatures if signature not in direct]
+        key_imgs = render_keys([unique[signature] for signature in dict.fromkeys(needed)], workers, chunksize, processes)
+
+        # paste in key order so overlapping keys stack the same way
+        uses, rendered, held, peak, composited = collections.Counter(needed), {}, 0, 0, 0
+        for signature, location in zip(self.signatures, self.locations):
+            if signature in direct:
+                unique[signature].composite(self.keyboard, tuple(location[:2]))
+                composited += 1
+                continue
+            if signature not in rendered:
+                rendered[signature] = next(key_imgs)
+                held += img_bytes(rendered[signature])
+                peak = max(peak, held)
+            key_img = rendered[signature]
+            uses[signature] -= 1
+            if not uses[signature]: held -= img_bytes(rendered.pop(signature))
+            with metrics.timed('paste'): self.keyboard.paste(key_img, (location[0], location[1]), mask=key_img)
+        with metrics.timed('watermark'): self.watermark_keyboard(watermark, self.scale)
+
+        self.stats = {'keys': len(self.keys), 'rendered': len(unique), 'caps': caps.info()}
+        self.stats['hit_rate'] = 1 - len(unique) / len(self.keys) if self.keys else 0.0
+        # key images allocated and most bytes of them held at once, direct keys need none
+        self.stats.update(direct=composited, key_images=len(uses), peak_key_bytes=peak)
         return self.keyboard
 
 
-    def render_key(self, key, scale, border):
-        # render key and scale resulting image for subpixel accuracy
-        key_img = key.render(scale, False)
+    def preview(self, width=None, height=None, flat=False, workers=1, chunksize=8, processes=False):
+        # render keys at thumbnail resolution, only resampling what's left over from rounding
+        img = self.render(workers, chunksize, processes, scale=self.get_preview_scale(width, height), flat=flat)
+        img.thumbnail((width or img.width, height or img.height), Image.LANCZOS)
+        return img
+
+
+    def render_region(self, box, key_imgs, indices):
+        # composite given keys overlapping box onto a canvas of its size
+        region = Image.new('RGB', (box[2] - box[0], box[3] - box[1]), color=self.color)
+        for i in indices:
+            location, key_img = self.locations[i], key_imgs[self.signatures[i]]
+            with metrics.timed('paste'): region.paste(key_img, (location[0] - box[0], location[1] - box[1]), mask=key_img)
+        with metrics.timed('watermark'): self.watermark_keyboard(watermark, self.scale, region, box[:2])
+        return region
+
+
+    def render_tiles(self, tile_size=512, scale=1, workers=1, chunksize=8, processes=False):
+        # unlike render, scale isn't capped, memory is bounded by tile size instead
+        unique = self.prepare(scale)
+        (w, h), index = self.max_size, {}
+        cols, rows = math.ceil(w / tile_size), math.ceil(h / tile_size)
+
+        # index keys by the tiles their pixel bounds overlap, keeping key order
+        for i, (left, upper, right, lower) in enumerate(self.locations):
+            for row in range(max(upper // tile_size, 0), min((lower - 1) // tile_size, rows - 1) + 1):
+                for col in range(max(left // tile_size, 0), min((right - 1) // tile_size, cols - 1) + 1):
+                    index.setdefault((col, row), []).append(i)
+        uses = collections.Counter(self.signatures[i] for indices in index.values() for i in indices)
+        return self.iter_tiles(unique, index, uses, tile_size, (workers, chunksize, processes))
+
+
+    def iter_tiles(self, unique, index, uses, tile_size, pool_args):
+        # yield (box, tile) in row major order, rendering keys when first needed
+        (w, h), key_imgs, rendered = self.max_size, {}, 0
+        for row in range(math.ceil(h / tile_size)):
+            for col in range(math.ceil(w / tile_size)):
+                indices = index.get((col, row), [])
+                missing = list(dict.fromkeys(self.signatures[i] for i in indices if self.signatures[i] not in key_imgs))
+                key_imgs.update(zip(missing, render_keys([unique[s] for s in missing], *pool_args)))
+                rendered += len(missing)
 
-        # paste in proper location and update max_size
-        location = [coord + border for coord in key.get_location(key_img)]
-        self.max_size = [max(location[2], self.max_size[0]), max(location[3], self.max_size[1])]
-        self.expand_keyboard(scale)
-        self.keyboard.paste(key_img, (location[0], location[1]), mask=key_img)
+                box = (col * tile_size, row * tile_size, min((col + 1) * tile_size, w), min((row + 1) * tile_size, h))
+                yield box, self.render_region(box, key_imgs, indices)
 
+                # drop key images once the last tile they overlap is done
+                for i in indices:
+                    uses[self.signatures[i]] -= 1
+                    if not uses[self.signatures[i]]: del key_imgs[self.signatures[i]]
 
-    def expand_keyboard(self, scale):
-        if all(self.max_size[i] < self.keyboard.size[i] for i in range(2)): return
-        new_size = tuple(int(size + 1000 / scale) for size in self.max_size)
-        new_keyboard = Image.new('RGB', new_size, color=self.color)
-        new_keyboard.paste(self.keyboard, (0, 0))
-        self.keyboard = new_keyboard
+        self.stats = {'keys': len(self.keys), 'rendered': rendered, 'caps': caps.info()}
+        self.stats['hit_rate'] = 1 - rendered / len(self.keys) if self.keys else 0.0
 
 
-    def watermark_keyboard(self, text, scale):
+    def get_watermark_font(self, scale):
+        return fonts.get('fonts/SA_font.ttf', int(36 / scale)), int(18 / scale)
+
+
+    def watermark_keyboard(self, text, scale, img=None, offset=(0, 0)):
         # config margin size and watermark colors
-        margin = int(18 / scale)
+        font, margin = self.get_watermark_font(scale)
         background_color = ImageColor.getrgb('#202020')
         text_color = ImageColor.getrgb('#E0E0E0')
 
-        # calculate size of watermark
-        draw = ImageDraw.Draw(self.keyboard)
-        font = ImageFont.truetype('fonts/SA_font.ttf', int(36 / scale))
-        w, h = font.getsize(text)
-        self.max_size = size = [max(w, self.max_size[0]), (self.max_size[1] + h + margin * 2)]
+        # draw watermark bar along bottom of planned canvas, shifted into region at offset
+        img = self.keyboard if img is None else img
+        (x, y), size, h = (-offset[0], -offset[1]), self.max_size, font.getsize(text)[1]
+        if y + size[1] - h - margin * 2 >= img.height: return
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((x, y + size[1] - h - margin * 2, x + size[0] + 1, y + size[1] + 1), fill=background_color)
+        draw.text((x + margin, y + size[1] - h - margin), text, font=font, fill=text_color)
+
+
+pools, pools_lock = {}, threading.Lock()
+
+
+def get_pool(workers, processes):
+    # pillow releases the gil for most operations, so threads are usually enough
+    with pools_lock:
+        if (workers, processes) not in pools:
+            executor = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+            pools[(workers, processes)] = executor(workers)
+        return pools[(workers, processes)]
+
+
+def render_key(key):
+    # module level so process pools can pickle it
+    return key.render()
+
+
+def warm_key(key):
+    # whether key can be composited straight onto the canvas, with its cap and legends cached if so
+    if not key.is_direct(): return False
+    key.warm()
+    return True
+
 
-        # draw watermark bar below image
-        draw.rectangle((0, size[1] - h - margin * 2, size[0] + 1, size[1] + 1), fill=background_color)
-        draw.text((margin, size[1] - h - margin), text, font=font, fill=text_color)
+def find_direct(unique, workers, chunksize, processes):
+    # signatures of simple keys, whose caps and legends are prepared on the pool so compositing only pastes
+    # caches warmed in other processes don't help this one, so with processes every key is rendered there
+    if processes and workers > 1: return set()
+    if workers > 1: simple = get_pool(workers, processes).map(metrics.propagate(warm_key), unique.values(), chunksize=chunksize)
+    else: simple = (key.is_direct() for key in unique.values())
+    return {signature for signature, is_simple in zip(unique, simple) if is_simple}
+
+
+def render_keys(keys, workers, chunksize, processes):
+    # lazily render keys in order, on a shared pool when there's more than one worker
+    if workers > 1 and processes: return get_pool(workers, processes).map(render_key, keys, chunksize=chunksize)
+    if workers > 1: return get_pool(workers, processes).map(metrics.propagate(render_key), keys, chunksize=chunksize)
+    return map(render_key, keys)
+
+
+@functools.lru_cache(maxsize=1)
+def get_icons():
+    # icon class to unicode tables, loaded once per process
+    with open('fonts/fa2unicode.json') as fa, open('fonts/kbd-webfont2unicode.json') as kb:
+        return json.load(fa), json.load(kb)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_labels(key):
+    # kits repeat the same legends, so parse each raw key string once
+    labels, pic = get_labels(key, *get_icons())
+    return tuple(str(label) for label in labels), pic
 
 
 def get_labels(key, fa_subs, kb_subs):
     # split into labels for each part of key
     labels = key.split('\n')
     for i, label in enumerate(labels):
+        # plain text has no tags or entities to handle, lxml drops it if it's only whitespace
+        if plain_label.match(label):
+            labels[i] = label if label.strip() else ''
+            continue
         tree = lxml.html.fragment_fromstring(label, create_parent=True)
         # set key.pic to true and make label url of image
         if tree.xpath('//img[1]/@src'):
@@ -116,30 +291,40 @@ def get_fonts(css):
                     ids = ('keylabels', 'keylabel', f'keylabel{i}')
                     if sel.lower_value in ids: fonts[i] = font
 
-        # download ttfs from @font-face
+        # collect ttf urls from @font-face, downloaded later by prefetch
         if rule.type == 'at-rule' and rule.lower_at_keyword == 'font-face':
             decls = tinycss2.parse_declaration_list(rule.content)
             name = decl_name(decls, 'font-family', is_str)
             url = decl_name(decls, 'src', is_ttf)
-            if (url): ttfs[name] = requests.get(url).content
+            if (url): ttfs[name] = url
     return fonts
 
 
+def prefetch_assets(keys):
+    # download legend images and fonts concurrently, then hand bytes to keys
+    font_lists = {id(key.fonts): key.fonts for key in keys}.values()
+    pic_keys = [key for key in keys if key.pic and key.labels]
+    urls = [url for font in font_lists for url in font] + [key.labels[0] for key in pic_keys]
+    with metrics.timed('fetch_assets'): assets = prefetcher.prefetch(urls)
+    sources = {url: font_source(assets.get(url)) for font in font_lists for url in font if url}
+    for font in font_lists: font[:] = [sources.get(url) for url in font]
+    for key in pic_keys: key.pic_data = assets.get(key.labels[0])
+    # number of fonts and legend images left out because they failed or were too slow
+    return sum(1 for data in assets.values() if data is None)
+
+
 def deserialise(rows):
     # Initialize with defaults
-    keys, backcolor, current = [], '#EEEEEE', Key()
+    keyset, backcolor, current = KeySet(), '#EEEEEE', Key()
     color_format = re.compile(r'^#([A-Fa-f0-9]{6}|[A-Fa-f0-9]{3})$')
     default_size = current.label_sizes[0]
-    with open('fonts/fa2unicode.json') as fa, open('fonts/kbd-webfont2unicode.json') as kb:
-        fa_subs, kb_subs = json.load(fa), json.load(kb)
 
     for row in rows:
         if isinstance(row, list):
             for key in row:
                 if isinstance(key, str):
-                    newKey = copy.copy(current)
-                    newKey.labels, newKey.pic = get_labels(key, fa_subs, kb_subs)
-                    keys.append(newKey)
+                    with metrics.timed('get_labels'): labels, pic = parse_labels(key)
+                    keyset.append(current, labels, pic)
 
                     # Set up for the next key
                     current.x += current.width
@@ -210,4 +395,5 @@ def deserialise(rows):
             if 'css' in row:
                 try: current.fonts = get_fonts(row['css'])
                 except Exception: pass
-    return keys, backcolor
+    missing = prefetch_assets(keyset.freeze().keys)
+    return keyset, backcolor, missing
@@ -0,0 +1,98 @@
+import math, operator
+import numpy as np
+from key import Key, rotated_size, special_keys
+
+
+geometry = ['x', 'y', 'width', 'height', 'x2', 'y2', 'width2', 'height2', 'rotation_angle', 'rotation_x', 'rotation_y']
+style = ['str_profile', 'color', 'align', 'fonts', 'label_sizes', 'label_colors', 'step', 'decal', 'ghost']
+get_geometry, get_style = operator.attrgetter(*geometry), operator.attrgetter(*style)
+
+
+class KeySet:
+    __slots__ = ['rows', 'styles', 'style_ids', 'style_index', 'labels', 'array', 'decal', 'keys']
+
+
+    def __init__(self):
+        # geometry of every key as float columns, other properties interned as shared styles
+        self.rows, self.styles, self.style_ids, self.style_index, self.labels = [], [], [], {}, []
+        self.array, self.decal, self.keys = None, None, []
+
+
+    def append(self, current, labels, pic):
+        # current is the parser's running key, styles only change when a property does
+        values = get_style(current)
+        # the table holds on to every value, so ids of its entries can't be reused
+        key = tuple(map(id, values))
+        if key not in self.style_index:
+            self.style_index[key] = len(self.styles)
+            self.styles.append(values)
+        self.rows.append(get_geometry(current))
+        self.style_ids.append(self.style_index[key])
+        self.labels.append((labels, pic))
+
+
+    def freeze(self):
+        # build columns and a Key for each row, which rendering and callers work with
+        self.array = np.array(self.rows, dtype=float).reshape(-1, len(geometry))
+        self.decal = np.array([self.styles[i][style.index('decal')] for i in self.style_ids], dtype=bool)
+        template, self.keys = Key(), []
+        for row, style_id, (labels, pic) in zip(self.rows, self.style_ids, self.labels):
+            key = Key.__new__(Key)
+            (key.x, key.y, key.width, key.height, key.x2, key.y2, key.width2, key.height2,
+             key.rotation_angle, key.rotation_x, key.rotation_y) = row
+            (key.str_profile, key.color, key.align, key.fonts, key.label_sizes, key.label_colors,
+             key.step, key.decal, key.ghost) = self.styles[style_id]
+            key.res, key.model_res, key.flat = template.res, template.model_res, False
+            key.labels, key.pic, key.pic_data = list(labels), pic, None
+            self.keys.append(key)
+        return self
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def __getitem__(self, i):
+        return self.keys[i]
+
+
+    def sizes(self, res, flat):
+        # pixel size of every key's rendered image at once, res per key
+        w, h, x2, y2, w2, h2, angle = (self.array[:, geometry.index(c)] for c in (
+            'width', 'height', 'x2', 'y2', 'width2', 'height2', 'rotation_angle'
+        ))
+        width = np.where(x2 >= 0, np.maximum(w2 + x2, w), np.maximum(w - x2, w2))
+        height = np.where(y2 >= 0, np.maximum(h2 + y2, h), np.maximum(h - y2, h2))
+        plain = (w2 == 0.0) & (h2 == 0.0) | self.decal
+        sizes = np.stack([
+            (np.where(plain, w, width) * res + 1).astype(int), (np.where(plain, h, height) * res).astype(int)
+        ], axis=1)
+        for props, (_, units) in special_keys.items():
+            special = (self.array[:, 2:8] == props).all(axis=1) & ~self.decal
+            sizes[special] = np.stack([(res[special] * units[0]).astype(int), (res[special] * units[1]).astype(int)], axis=1)
+
+        # expanded size of rotated images, once per distinct size and angle
+        rotated = (angle % 180 != 0) & (not flat)
+        if rotated.any():
+            keys, inverse = np.unique(np.column_stack([sizes[rotated], angle[rotated]]), axis=0, return_inverse=True)
+            sizes[rotated] = np.array([rotated_size((int(w), int(h)), -a) for w, h, a in keys])[inverse.ravel()]
+        return sizes
+
+
+    def locations(self, res, flat):
+        # pixel location of every key at once as (left, upper, right, lower) rows
+        (x, y, w, h, x2, y2, _, _, angle, rx, ry), sizes = self.array.T, self.sizes(res, flat)
+        x, y, (size_w, size_h) = np.minimum(x, x + x2), np.minimum(y, y + y2), sizes.T
+
+        rotated = (angle != 0) | (rx != 0) | (ry != 0)
+        if rotated.any():
+            # same operations in the same order as placing keys one at a time, so pixels land identically
+            angles, inverse = np.unique(angle, return_inverse=True)
+            cos = np.array([math.cos(math.radians(a)) for a in angles])[inverse]
+            sin = np.array([math.sin(math.radians(a)) for a in angles])[inverse]
+            x_rot, y_rot = x * cos - y * sin, y * cos + x * sin
+            left, top = -w / 2, -h / 2
+            left_rot, top_rot = left * cos - top * sin, top * cos + left * sin
+            x = np.where(rotated, rx + x_rot - size_w / res / 2 - left_rot, x)
+            y = np.where(rotated, ry + y_rot - size_h / res / 2 - top_rot, y)
+        return np.stack([x * res, y * res, x * res + size_w, y * res + size_h], axis=1).astype(int)
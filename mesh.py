@@ -0,0 +1,75 @@
+import numpy as np
+
+
+class BlenderMesh:
+    __slots__ = ['data']
+
+
+    def __init__(self, model):
+        # mesh data of a blender object, read and written in bulk
+        self.data = model.data
+
+
+    def coords(self):
+        co = np.empty(len(self.data.vertices) * 3, dtype=np.float32)
+        self.data.vertices.foreach_get('co', co)
+        return co.reshape(-1, 3)
+
+
+    def set_coords(self, co):
+        self.data.vertices.foreach_set('co', np.ascontiguousarray(co, dtype=np.float32).ravel())
+        self.data.update()
+
+
+    def flat_shade(self):
+        self.data.polygons.foreach_set('use_smooth', np.zeros(len(self.data.polygons), dtype=bool))
+
+
+class ArrayMesh:
+    __slots__ = ['co', 'smooth']
+
+
+    def __init__(self, co, polygons=0):
+        # numpy stand-in with the same interface, for tests and benchmarks without blender
+        self.co, self.smooth = np.array(co, dtype=np.float32).reshape(-1, 3), np.ones(polygons, dtype=bool)
+
+
+    def coords(self):
+        return self.co.copy()
+
+
+    def set_coords(self, co):
+        self.co = np.array(co, dtype=np.float32).reshape(-1, 3)
+
+
+    def flat_shade(self):
+        self.smooth[:] = False
+
+
+def as_mesh(model):
+    return model if isinstance(model, ArrayMesh) else BlenderMesh(model)
+
+
+def stretch(co, axis, units, res):
+    # stretch one axis of float32 coords in place, x grows to -x and y to +y, true if shading has to be flat
+    # math is done in doubles and stored as float32, like setting v.co one vertex at a time
+    sign, v = (-1, 1)[axis], co[:, axis].astype(float)
+    if units > 1:
+        # shift far section out
+        co[:, axis] = np.where(sign * v > res / 2, v + sign * ((units - 1) * res), v)
+    elif units < 1:
+        # keep near section, compress middle section, shift far section in
+        mid = units * res / 2
+        far = np.where(sign * v < res - mid, sign * mid, v - sign * res + sign * mid * 2)
+        co[:, axis] = np.where(sign * v < mid, v, far)
+    return units < 1
+
+
+def deform(mesh, res, width=1, height=1, offset=(0, 0), mirror=None):
+    # one read and one write of every vertex: mirror x around mirror / 2, stretch, then offset in x/y
+    co = mesh.coords()
+    if mirror is not None: co[:, 0] = mirror - co[:, 0].astype(float)
+    flat = stretch(co, 0, width, res) | stretch(co, 1, height, res)
+    if offset != (0, 0): co[:, :2] = co[:, :2].astype(float) + offset
+    mesh.set_coords(co)
+    if flat: mesh.flat_shade()
@@ -0,0 +1,114 @@
+import bisect, contextlib, contextvars, functools, threading, time
+
+
+enabled = False
+buckets = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+timings = contextvars.ContextVar('timings', default=None)
+histograms, sources, lock = {}, {}, threading.Lock()
+disabled = contextlib.nullcontext()
+
+
+class Timer:
+    __slots__ = ['name', 'start']
+
+
+    def __init__(self, name):
+        self.name = name
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+
+
+def timed(name):
+    # shared no-op context when disabled, so hot paths only pay for a call
+    return Timer(name) if enabled else disabled
+
+
+def timer(name):
+    # decorator form of timed, checked on every call
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled: return fn(*args, **kwargs)
+            with Timer(name): return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def record(name, seconds):
+    request = timings.get()
+    with lock:
+        histogram = histograms.get(name)
+        if histogram is None: histogram = histograms[name] = [[0] * (len(buckets) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(buckets, seconds)] += 1
+        histogram[1], histogram[2] = histogram[1] + seconds, histogram[2] + 1
+        if request is not None:
+            total = request.setdefault(name, [0.0, 0])
+            total[0], total[1] = total[0] + seconds, total[1] + 1
+
+
+def begin():
+    # start collecting timings of the current request
+    return timings.set({}) if enabled else None
+
+
+def end(token):
+    if token is not None: timings.reset(token)
+
+
+def propagate(fn):
+    # run fn on pool threads with the caller's request timings
+    request = timings.get()
+    if request is None: return fn
+
+    def run(*args):
+        token = timings.set(request)
+        try:
+            return fn(*args)
+        finally:
+            timings.reset(token)
+    return run
+
+
+def server_timing():
+    # Server-Timing header of stages in the current request, total ms and count
+    request = timings.get()
+    if not request: return None
+    with lock: items = sorted(request.items())
+    return ', '.join('{};dur={:.2f};desc="x{}"'.format(name, total * 1000, count) for name, (total, count) in items)
+
+
+def register(name, info):
+    # info returns a dict of counters, exported as gauges labelled with name
+    sources[name] = info
+
+
+def export():
+    # prometheus text format of stage histograms and cache counters
+    lines = ['# TYPE kle_stage_seconds histogram']
+    with lock: items = sorted((name, [list(h[0]), h[1], h[2]]) for name, h in histograms.items())
+    for name, (counts, total, count) in items:
+        cumulative = 0
+        for bound, n in zip(buckets + ('+Inf',), counts):
+            cumulative += n
+            lines.append('kle_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(name, bound, cumulative))
+        lines.append('kle_stage_seconds_sum{{stage="{}"}} {}'.format(name, total))
+        lines.append('kle_stage_seconds_count{{stage="{}"}} {}'.format(name, count))
+
+    gauges = {}
+    for source, info in sorted(sources.items()):
+        for stat, value in (info() or {}).items():
+            # one level of nesting becomes a key label, e.g. per encoder format
+            values = value.items() if isinstance(value, dict) else [(None, value)]
+            for key, value in values:
+                if not isinstance(value, (int, float)) or isinstance(value, bool): continue
+                labels = 'source="{}"'.format(source) + (',key="{}"'.format(key) if key is not None else '')
+                gauges.setdefault(stat, []).append('kle_{}{{{}}} {}'.format(stat, labels, value))
+    for stat, values in sorted(gauges.items()):
+        lines += ['# TYPE kle_{} gauge'.format(stat)] + values
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,120 @@
+import collections, threading, time
+from atlas import img_bytes
+from cache import LRUCache
+from keyboard import Keyboard, render_keys
+import encoders, metrics
+
+
+class Session:
+    __slots__ = ['keyboard', 'key_imgs', 'placements', 'expires', 'lock']
+
+
+    def __init__(self):
+        # previous parse, images of its distinct keys and its composited canvas
+        self.keyboard, self.key_imgs, self.placements = None, {}, []
+        self.expires, self.lock = 0, threading.Lock()
+
+
+    def update(self, keyboard, workers=1, chunksize=8, processes=False):
+        # render keys not seen before, then recomposite only boxes where placements changed
+        prev, unique = self.keyboard, keyboard.prepare(keyboard.get_scale())
+        missing = [signature for signature in unique if signature not in self.key_imgs]
+        self.key_imgs.update(zip(missing, render_keys([unique[s] for s in missing], workers, chunksize, processes)))
+        self.key_imgs = {signature: self.key_imgs[signature] for signature in unique}
+        # rotated key images can be a pixel larger than their planned box
+        extents = [
+            (l[0], l[1], l[0] + self.key_imgs[s].width, l[1] + self.key_imgs[s].height)
+            for s, l in zip(keyboard.signatures, keyboard.locations)
+        ]
+        placements = list(zip(keyboard.signatures, extents))
+
+        (w, h), full = keyboard.max_size, (0, 0) + keyboard.max_size
+        if prev is None or (prev.scale, prev.max_size, prev.color) != (keyboard.scale, keyboard.max_size, keyboard.color):
+            boxes, keyboard.keyboard = [full], None
+        else:
+            # keys removed or added, by signature and extent, leave dirty boxes at both old and new spots
+            old, new = collections.Counter(self.placements), collections.Counter(placements)
+            boxes = merge_boxes(dict.fromkeys(extent for _, extent in (old - new) + (new - old)))
+            # only stacking order changed, so overlapping keys have to be repainted
+            if not boxes and placements != self.placements: boxes = [full]
+            keyboard.keyboard = prev.keyboard
+
+        for box in boxes:
+            box = (max(box[0], 0), max(box[1], 0), min(box[2], w), min(box[3], h))
+            if box[0] >= box[2] or box[1] >= box[3]: continue
+            # neighbors overlapping the box are repainted too, in key order
+            indices = [i for i, extent in enumerate(extents) if overlaps(extent, box, 0)]
+            region = keyboard.render_region(box, self.key_imgs, indices)
+            if keyboard.keyboard is None: keyboard.keyboard = region
+            else: keyboard.keyboard.paste(region, box[:2])
+
+        self.keyboard, self.placements = keyboard, placements
+        keyboard.stats = {'keys': len(keyboard.keys), 'rendered': len(missing), 'dirty': len(boxes), 'full': boxes == [full]}
+        keyboard.stats['hit_rate'] = 1 - len(missing) / len(keyboard.keys) if keyboard.keys else 0.0
+        return keyboard.keyboard
+
+
+    def nbytes(self):
+        canvas = img_bytes(self.keyboard.keyboard) if self.keyboard else 0
+        return canvas + sum(img_bytes(img) for img in self.key_imgs.values())
+
+
+def overlaps(a, b, margin):
+    return a[0] < b[2] + margin and a[2] + margin > b[0] and a[1] < b[3] + margin and a[3] + margin > b[1]
+
+
+def merge_boxes(boxes):
+    # union boxes that overlap or touch, so keys shared by them are repainted once
+    merged = []
+    for box in boxes:
+        hit = next((m for m in merged if overlaps(m, box, 1)), None)
+        while hit:
+            merged.remove(hit)
+            box = (min(box[0], hit[0]), min(box[1], hit[1]), max(box[2], hit[2]), max(box[3], hit[3]))
+            hit = next((m for m in merged if overlaps(m, box, 1)), None)
+        merged.append(box)
+    return merged
+
+
+class SessionStore:
+    __slots__ = ['sessions', 'ttl', 'lock', 'stats']
+
+
+    def __init__(self, max_bytes=256 * 2**20, ttl=900):
+        # sessions by client chosen id, dropped once idle for ttl or least recently used over max_bytes
+        self.sessions = LRUCache(max_bytes, sizeof=lambda session: session.nbytes())
+        self.ttl, self.lock = ttl, threading.Lock()
+        self.stats = {'full': 0, 'incremental': 0, 'expired': 0}
+
+
+    def render(self, id, layout, fmt='png', workers=1, chunksize=8, processes=False):
+        # encoded while the session is locked, so a concurrent update can't change the canvas underneath
+        with self.lock:
+            self.expire()
+            session = self.sessions.get(id) or Session()
+        with session.lock:
+            with metrics.timed('render'): img = session.update(Keyboard(layout), workers, chunksize, processes)
+            data = encoders.encode(img, fmt)
+            session.expires = time.monotonic() + self.ttl
+            self.sessions.set(id, session)
+            full = session.keyboard.stats['full']
+        with self.lock: self.stats['full' if full else 'incremental'] += 1
+        return data
+
+
+    def delete(self, id):
+        self.sessions.pop(id)
+
+
+    def expire(self):
+        # least recently used sessions come first, so stop at the first one still alive, caller holds lock
+        now = time.monotonic()
+        while True:
+            oldest = self.sessions.oldest()
+            if oldest is None or oldest[1].expires > now: break
+            self.sessions.pop(oldest[0])
+            self.stats['expired'] += 1
+
+
+    def info(self):
+        with self.lock: return dict(self.sessions.info(), **self.stats)
@@ -0,0 +1,52 @@
+import http.server, os, sys, threading
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+    # local http server answering from routes, path -> fn(request headers) -> (status, headers, body)
+    daemon_threads = True
+
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.routes, self.requests, self.lock = {}, [], threading.Lock()
+
+
+    def url(self, path=''):
+        return 'http://127.0.0.1:{}{}'.format(self.server_port, path)
+
+
+    def count(self, path):
+        with self.lock: return sum(1 for p, _ in self.requests if p == path)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock: self.server.requests.append((self.path, dict(self.headers)))
+        route = self.server.routes.get(self.path)
+        status, headers, body = route(self.headers) if route else (404, {}, b'')
+        self.send_response(status)
+        for name, value in headers.items(): self.send_header(name, value)
+        self.end_headers()
+        # body is bytes, or an iterable of chunks sent as they come
+        try:
+            for chunk in [body] if isinstance(body, bytes) else body:
+                self.wfile.write(chunk)
+                self.wfile.flush()
+        except OSError:
+            pass
+
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = StandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,66 @@
+import threading, time
+from assets import Prefetcher
+
+
+def blob(data, delay=0, length=True):
+    def route(headers):
+        time.sleep(delay)
+        return 200, {'Content-Length': str(len(data))} if length else {}, data
+    return route
+
+
+def test_prefetch_downloads_each_url_once(server):
+    server.routes = {'/a.ttf': blob(b'a' * 100), '/b.png': blob(b'b' * 10)}
+    a, b = server.url('/a.ttf'), server.url('/b.png')
+    results = Prefetcher(workers=4).prefetch([a, None, b, a, '', a])
+    assert results == {a: b'a' * 100, b: b'b' * 10}
+    assert server.count('/a.ttf') == 1 and server.count('/b.png') == 1
+
+
+def test_prefetch_leaves_out_failed_assets(server):
+    server.routes = {'/a.ttf': blob(b'a')}
+    missing = server.url('/missing.ttf')
+    assert Prefetcher().prefetch([server.url('/a.ttf'), missing]) == {server.url('/a.ttf'): b'a', missing: None}
+
+
+def test_prefetch_stops_at_budget(server):
+    server.routes = {'/fast.png': blob(b'f'), '/slow.png': blob(b's', delay=2)}
+    fast, slow = server.url('/fast.png'), server.url('/slow.png')
+    start = time.monotonic()
+    results = Prefetcher(budget=0.5).prefetch([fast, slow])
+    assert time.monotonic() - start < 1.5
+    assert results == {fast: b'f', slow: None}
+
+
+def test_prefetch_refuses_oversized_assets(server):
+    server.routes = {
+        '/declared.png': blob(b'x' * 2000), '/undeclared.png': blob(b'x' * 2000, length=False),
+        '/small.png': blob(b'x' * 1000),
+    }
+    urls = [server.url(p) for p in ('/declared.png', '/undeclared.png', '/small.png')]
+    results = Prefetcher(max_asset_bytes=1000).prefetch(urls)
+    assert [results[url] for url in urls] == [None, None, b'x' * 1000]
+
+
+def trickle(size, interval):
+    # one byte at a time, each read well within the socket timeout
+    def chunks():
+        for _ in range(size):
+            time.sleep(interval)
+            yield b'x'
+    return lambda headers: (200, {'Content-Length': str(size)}, chunks())
+
+
+def test_slow_downloads_stop_at_deadline(server):
+    server.routes = {'/slow1.ttf': trickle(40, 0.2), '/slow2.ttf': trickle(40, 0.2), '/fast.png': blob(b'f')}
+    prefetcher, threads = Prefetcher(workers=2, timeout=1, budget=1), threading.active_count()
+    start = time.monotonic()
+    assert prefetcher.prefetch([server.url('/slow1.ttf'), server.url('/slow2.ttf')]) == dict.fromkeys(
+        [server.url('/slow1.ttf'), server.url('/slow2.ttf')]
+    )
+    assert time.monotonic() - start < 1.5
+
+    # next request isn't starved by the slow ones, which give up shortly after the deadline
+    assert prefetcher.prefetch([server.url('/fast.png')]) == {server.url('/fast.png'): b'f'}
+    time.sleep(1)
+    assert threading.active_count() <= threads
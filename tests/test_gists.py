@@ -0,0 +1,56 @@
+import concurrent.futures, json, time
+import github, pytest
+from gists import GistCache
+
+
+def gist(layout, etag='"v1"', delay=0):
+    # github api response with one layout file, 304 when the client already has etag
+    body = json.dumps({'files': {'layout.kbd.json': {'content': json.dumps(layout)}}}).encode('utf-8')
+    def route(headers):
+        time.sleep(delay)
+        if headers.get('If-None-Match') == etag: return 304, {'ETag': etag}, b''
+        return 200, {'ETag': etag, 'Content-Type': 'application/json'}, body
+    return route
+
+
+def test_concurrent_requests_share_one_fetch(server):
+    server.routes = {'/gists/abc': gist([['A']], delay=0.3)}
+    cache = GistCache(None, server.url())
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        layouts = list(pool.map(cache.get_layout, ['abc'] * 8))
+    assert layouts == [[['A']]] * 8
+    assert server.count('/gists/abc') == 1
+
+
+def test_fresh_entries_are_not_refetched(server):
+    server.routes = {'/gists/abc': gist([['A']])}
+    cache = GistCache(None, server.url(), ttl=60)
+    assert cache.get_layout('abc') == cache.get_layout('abc') == [['A']]
+    assert server.count('/gists/abc') == 1
+
+
+def test_expired_entries_are_revalidated(server):
+    server.routes = {'/gists/abc': gist([['A']])}
+    cache = GistCache('token', server.url(), ttl=0)
+    assert cache.get_layout('abc') == [['A']]
+    assert cache.get_layout('abc') == [['A']]
+    (_, first), (_, second) = server.requests
+    assert 'If-None-Match' not in first and second['If-None-Match'] == '"v1"'
+    assert second['Authorization'] == 'token token'
+
+
+def test_changed_gists_are_parsed_again(server):
+    server.routes = {'/gists/abc': gist([['A']])}
+    cache = GistCache(None, server.url(), ttl=0)
+    cache.get_layout('abc')
+    server.routes = {'/gists/abc': gist([['B']], etag='"v2"')}
+    assert cache.get_layout('abc') == [['B']]
+
+
+def test_missing_gists_raise(server):
+    cache = GistCache(None, server.url())
+    with pytest.raises(github.UnknownObjectException):
+        cache.get_layout('missing')
+    server.routes = {'/gists/empty': lambda headers: (200, {}, json.dumps({'files': {}}).encode('utf-8'))}
+    with pytest.raises(github.UnknownObjectException):
+        cache.get_layout('empty')
@@ -0,0 +1,101 @@
+import types
+import numpy as np
+import pytest
+from key import Key
+from mesh import ArrayMesh, deform
+
+res = Key().model_res
+
+
+class Vector:
+    # blender vector, float32 storage read back as python floats
+    def __init__(self, co):
+        self.co = np.array(co, dtype=np.float32)
+
+
+    def __getitem__(self, i):
+        return float(self.co[i])
+
+
+    def __setitem__(self, i, value):
+        self.co[i] = value
+
+
+def loop_model(co, polygons):
+    vertices = [types.SimpleNamespace(co=Vector(v)) for v in co]
+    faces = [types.SimpleNamespace(use_smooth=True) for _ in range(polygons)]
+    return types.SimpleNamespace(data=types.SimpleNamespace(vertices=vertices, polygons=faces))
+
+
+def loop_stretch(model, width, height):
+    # stretch_model as it was, one vertex at a time
+    if width > 1:
+        for v in model.data.vertices:
+            v.co[0] -= (width - 1) * res if v.co[0] < -res / 2 else 0
+    elif width < 1:
+        mid = width * res / 2
+        for v in model.data.vertices:
+            v.co[0] = v.co[0] if v.co[0] > -mid else (-mid if v.co[0] > -res + mid else v.co[0] + res - mid * 2)
+        for p in model.data.polygons: p.use_smooth = False
+
+    if height > 1:
+        for v in model.data.vertices:
+            v.co[1] += (height - 1) * res if v.co[1] > res / 2 else 0
+    elif height < 1:
+        mid = height * res / 2
+        for v in model.data.vertices:
+            v.co[1] = v.co[1] if v.co[1] < mid else (mid if v.co[1] < res - mid else v.co[1] - res + mid * 2)
+        for p in model.data.polygons: p.use_smooth = False
+
+
+def base_mesh(seed, vertices=500):
+    # vertices around a 1u base model, some on exact section boundaries
+    rng = np.random.default_rng(seed)
+    co = np.column_stack([
+        rng.uniform(-res * 1.1, res * 0.1, vertices), rng.uniform(-res * 0.1, res * 1.1, vertices),
+        rng.uniform(0, res / 2, vertices)
+    ])
+    co[:4, :2] = [[-res / 2, res / 2], [0, 0], [-res, res], [-res / 4, res / 4]]
+    return co.astype(np.float32)
+
+
+def compare(model, mesh):
+    co = np.array([v.co.co for v in model.data.vertices])
+    assert co.tobytes() == mesh.co.tobytes()
+    assert [p.use_smooth for p in model.data.polygons] == mesh.smooth.tolist()
+
+
+sizes = [(1, 1), (2.25, 1), (6.25, 1), (1, 2), (1.75, 2), (0.5, 1), (1, 0.75), (0.25, 0.5), (0.75, 2), (1.333, 0.583)]
+
+
+@pytest.mark.parametrize('width, height', sizes)
+def test_stretch_matches_vertex_loop(width, height):
+    co = base_mesh(int(width * 100 + height))
+    model, mesh = loop_model(co, 40), ArrayMesh(co, 40)
+    loop_stretch(model, width, height)
+    Key().stretch_model(mesh, width, height)
+    compare(model, mesh)
+
+
+@pytest.mark.parametrize('width, height, x2, y2', [(1.25, 2, -0.25, 0), (1.5, 1, 0.25, -1), (0.75, 1, -0.75, -0.5)])
+def test_offset_matches_vertex_loop(width, height, x2, y2):
+    # touch surface of a key with a second surface, moved relative to the object origin
+    co = base_mesh(1)
+    model, mesh = loop_model(co, 40), ArrayMesh(co, 40)
+    loop_stretch(model, width, height)
+    for v in model.data.vertices:
+        v.co[0] -= max(-x2, 0) * res
+        v.co[1] += max(-y2, 0) * res
+    deform(mesh, res, width, height, (-max(-x2, 0) * res, max(-y2, 0) * res))
+    compare(model, mesh)
+
+
+@pytest.mark.parametrize('width, height', [(0.583, 1), (1.083, 2), (0.333, 0.5)])
+def test_mirror_matches_vertex_loop(width, height):
+    # left step of a stepped key, mirrored before it's stretched
+    co = base_mesh(2)
+    model, mesh = loop_model(co, 40), ArrayMesh(co, 40)
+    for v in model.data.vertices: v.co[0] = -res * 0.97 - v.co[0]
+    loop_stretch(model, width, height)
+    deform(mesh, res, width, height, mirror=-res * 0.97)
+    compare(model, mesh)
@@ -0,0 +1,77 @@
+import argparse, json, math, os, struct, zlib
+import numpy as np
+from PIL import Image
+from keyboard import Keyboard
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def png_stream(size, tiles, level=3):
+    # encode row major (box, tile) pairs as one rgb png, a band of tiles at a time
+    yield b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', struct.pack('>IIBBBBB', *size, 8, 2, 0, 0, 0))
+    compressor, prev = zlib.compressobj(level), np.zeros((1, size[0] * 3), dtype=np.uint8)
+    for box, tile in tiles:
+        if box[0] == 0: band = Image.new('RGB', (size[0], box[3] - box[1]))
+        band.paste(tile, (box[0], 0))
+        if box[2] < size[0]: continue
+
+        # up filter stores each scanline as difference from the one above
+        rows = np.asarray(band).reshape(band.height, -1)
+        filtered = np.empty((band.height, rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0], filtered[:, 1:] = 2, rows - np.concatenate((prev, rows[:-1]))
+        prev, data = rows[-1:], compressor.compress(filtered.tobytes())
+        if data: yield png_chunk(b'IDAT', data)
+    yield png_chunk(b'IDAT', compressor.flush()) + png_chunk(b'IEND', b'')
+
+
+def write_pyramid(path, size, tiles, tile_size, fmt='png'):
+    # deep zoom pyramid, full resolution tiles first then each level halved from the one below
+    top, files = max(math.ceil(math.log2(max(size))), 0), path + '_files'
+    tile_path = lambda level, col, row: os.path.join(files, str(level), '{}_{}.{}'.format(col, row, fmt))
+    os.makedirs(os.path.join(files, str(top)), exist_ok=True)
+    for box, tile in tiles:
+        tile.save(tile_path(top, box[0] // tile_size, box[1] // tile_size))
+
+    for level in range(top - 1, -1, -1):
+        os.makedirs(os.path.join(files, str(level)), exist_ok=True)
+        w, h = (math.ceil(s / 2 ** (top - level)) for s in size)
+        w2, h2 = (math.ceil(s / 2 ** (top - level - 1)) for s in size)
+        for row in range(math.ceil(h / tile_size)):
+            for col in range(math.ceil(w / tile_size)):
+                # join up to four tiles of the level below and halve them
+                x, y = col * tile_size * 2, row * tile_size * 2
+                tile = Image.new('RGB', (min(tile_size * 2, w2 - x), min(tile_size * 2, h2 - y)))
+                for j in range(2 if y + tile_size < h2 else 1):
+                    for i in range(2 if x + tile_size < w2 else 1):
+                        with Image.open(tile_path(level + 1, col * 2 + i, row * 2 + j)) as child:
+                            tile.paste(child, (i * tile_size, j * tile_size))
+                size2 = (min(tile_size, w - col * tile_size), min(tile_size, h - row * tile_size))
+                tile.resize(size2, resample=Image.BOX).save(tile_path(level, col, row))
+
+    with open(path + '.dzi', 'w') as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{}" Overlap="0" Format="{}">'
+            '<Size Width="{}" Height="{}"/></Image>\n'.format(tile_size, fmt, *size)
+        )
+    return path + '.dzi'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render a layout at full resolution into a deep zoom tile pyramid')
+    parser.add_argument('layout', help='raw data json downloaded from keyboard-layout-editor')
+    parser.add_argument('output', help='path of the .dzi file without extension, tiles go in <output>_files')
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--format', default='png', choices=['png', 'jpeg'], help='tile image format')
+    parser.add_argument('--workers', type=int, default=1, help='threads rendering keys')
+    args = parser.parse_args()
+
+    with open(args.layout) as f: keyboard = Keyboard(json.load(f))
+    tiles = keyboard.render_tiles(args.tile_size, 1, args.workers)
+    print(write_pyramid(args.output, keyboard.max_size, tiles, args.tile_size, args.format))
+
+
+if __name__ == '__main__':
+    main()
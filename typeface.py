@@ -0,0 +1,150 @@
+import hashlib, io, math, os, tempfile
+from PIL import Image, ImageDraw, ImageFont
+from cache import LRUCache, trim_dir, write_file
+
+
+def font_source(data):
+    # downloaded ttf paired with its digest, hashed once per layout rather than per lookup
+    return (hashlib.sha1(data).hexdigest(), data) if data is not None else None
+
+
+class FontRegistry:
+    __slots__ = ['cache', 'path', 'max_disk_bytes']
+
+
+    def __init__(self, max_bytes, path=None, max_disk_bytes=256 * 2**20):
+        # loaded fonts shared by every key and request, bounded by the size of their font files
+        self.cache = LRUCache(max_bytes, sizeof=lambda entry: entry[1])
+        self.path, self.max_disk_bytes = path, max_disk_bytes
+
+
+    def get(self, source, size):
+        return self.lookup(source, size)[1]
+
+
+    def lookup(self, source, size):
+        # font and its key, source is either a path to a ttf or a (digest, bytes) pair from font_source
+        key = (source if isinstance(source, str) else source[0], size)
+        entry = self.cache.get(key)
+        if entry is None:
+            # freetype reads files itself, so sizes of one font don't each keep a copy of its bytes
+            path = source if isinstance(source, str) else self.write(source)
+            try:
+                font = ImageFont.truetype(path, size)
+                entry = (font, os.path.getsize(path) if isinstance(path, str) else len(source[1]))
+            except Exception:
+                entry = (None, 1)
+            self.cache.set(key, entry)
+        return key, entry[0]
+
+
+    def write(self, source):
+        # downloaded fonts are written once per digest, bytes are only kept in memory if that fails
+        if self.path is None: self.path = tempfile.mkdtemp(prefix='kle-fonts-')
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, source[0] + '.ttf')
+        if not os.path.exists(path):
+            write_file(path, source[1])
+            trim_dir(self.path, self.max_disk_bytes)
+        return path if os.path.exists(path) else io.BytesIO(source[1])
+
+
+    def info(self):
+        return self.cache.info()
+
+
+class LabelCache:
+    __slots__ = ['layouts', 'masks', 'measure']
+
+
+    def __init__(self, max_bytes, max_layouts=16384):
+        # legend layouts and lines rasterised as alpha masks, shared by every key and request
+        # fonts are (key, font) pairs from the registry, entries are keyed on its key and never hold the font
+        self.layouts = LRUCache(max_layouts, sizeof=lambda layout: 1)
+        self.masks = LRUCache(max_bytes, sizeof=lambda entry: entry[0].width * entry[0].height if entry[0] else 1)
+        self.measure = ImageDraw.Draw(Image.new('L', (1, 1)))
+
+
+    def layout(self, text, font, spacing, limit=None, upper=False):
+        # wrapped lines of a legend, measured the way ImageDraw.multiline_text does
+        key = (text, font[0], spacing, limit, upper)
+        layout = self.layouts.get(key)
+        if layout is None:
+            font = font[1]
+            text = break_text(text, font, limit) if limit is not None else text
+            text = text.upper() if upper else text
+            lines = text.split('\n')
+            widths = [self.measure.textlength(line, font) for line in lines]
+            line_spacing = self.measure.textbbox((0, 0), 'A', font)[3] + spacing
+            layout = self.layouts.set(key, (font.getsize_multiline(text, spacing=spacing), lines, widths, line_spacing))
+        return layout
+
+
+    def draw(self, img, xy, layout, font, color, align, origin=(0, 0), size=None):
+        # same placement of each line as ImageDraw.multiline_text, on an image of size drawn into img at origin
+        # without img, lines are only rasterised into the cache
+        _, lines, widths, line_spacing = layout
+        top, max_width = xy[1], max(widths, default=0)
+        for line, line_width in zip(lines, widths):
+            left = xy[0]
+            if align == 'center': left += (max_width - line_width) / 2.0
+            elif align == 'right': left += max_width - line_width
+            self.draw_line(img, (left, top), line, font, color, origin, size or img.size)
+            top += line_spacing
+
+
+    def draw_line(self, img, xy, line, font, color, origin, size):
+        # glyphs are rasterised at the subpixel offset of the position, then tinted while pasting
+        (fx, x), (fy, y) = math.modf(xy[0]), math.modf(xy[1])
+        if fx < 0 or fy < 0:
+            # pillow rounds negative positions differently, so these get a mask of their own
+            if img is None: return
+            mask, box = Image.new('L', size), (0, 0)
+            ImageDraw.Draw(mask).text(xy, line, fill=255, font=font[1])
+        else:
+            key = (line, font[0], fx, fy)
+            mask, (dx, dy) = self.masks.get(key) or self.masks.set(key, rasterise(line, font[1], fx, fy))
+            if not mask or img is None: return
+            box = (int(x) + dx, int(y) + dy)
+            # clipped to size, the same as drawing onto an image of that size would be
+            crop = (max(-box[0], 0), max(-box[1], 0), min(size[0] - box[0], mask.width), min(size[1] - box[1], mask.height))
+            if crop[0] >= crop[2] or crop[1] >= crop[3]: return
+            if crop != (0, 0) + mask.size: mask, box = mask.crop(crop), (box[0] + crop[0], box[1] + crop[1])
+        img.paste(color, (origin[0] + box[0], origin[1] + box[1]), mask)
+
+
+    def clear(self):
+        self.layouts.clear()
+        self.masks.clear()
+
+
+    def info(self):
+        return dict(self.masks.info(), layouts=self.layouts.info()['items'])
+
+
+def rasterise(line, font, fx, fy):
+    # draw onto a canvas with room around the line's bounds, then crop to where there's ink
+    # origin stays positive, since pillow rounds negative positions toward zero
+    left, top, right, bottom = font.getbbox(line)
+    x, y = max(2 - left, 0), max(2 - top, 0)
+    canvas = Image.new('L', (x + right + 4, y + bottom + 4))
+    ImageDraw.Draw(canvas).text((x + fx, y + fy), line, fill=255, font=font)
+    box = canvas.getbbox()
+    if box is None: return None, (0, 0)
+    return canvas.crop(box), (box[0] - x, box[1] - y)
+
+
+def break_text(text, font, limit):
+    if not ' ' in text: return text
+    words, lines = text.split(' '), ['']
+    while words:
+        word = words.pop(0)
+        if font.getsize(lines[-1] + word)[0] + 1 < limit or len(lines[-1]) < 1:
+            lines[-1] += word + ' '
+        else:
+            lines.append(word + ' ')
+    return '\n'.join([line[:-1] for line in lines])
+
+
+fonts = FontRegistry(64 * 2**20)
+labels = LabelCache(32 * 2**20)